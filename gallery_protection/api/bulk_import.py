@@ -0,0 +1,266 @@
+import frappe
+import os
+import tarfile
+import uuid
+import zipfile
+from frappe import _
+from frappe.utils import now_datetime
+from werkzeug.utils import secure_filename
+from .image_store import validate_target, stream_to_temp, _remove_quietly
+from .normalizer import ingest_image
+from .render_cache import get_or_render
+from .storage import get_storage
+from .gallery_api import get_watermark_render, render_stored_image
+
+IMPORT_FORMATS = ['.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp']
+DEFAULT_MAX_ARCHIVE_BYTES = 2 * 1024 * 1024 * 1024
+DEFAULT_MAX_FILES = 1000
+DEFAULT_BATCH_SIZE = 20
+IMPORT_TTL = 86400
+
+
+def _meta_key(import_id):
+    return f"gallery_import:{import_id}"
+
+
+def _results_key(import_id):
+    return f"gallery_import_results:{import_id}"
+
+
+def _pending_key(import_id):
+    return frappe.cache().make_key(f"gallery_import_pending:{import_id}")
+
+
+def _open_archive(archive_path, kind):
+    if kind == "zip":
+        return zipfile.ZipFile(archive_path)
+    return tarfile.open(archive_path, mode="r:*")
+
+
+def _list_members(archive_path, kind):
+    """
+    Read the archive index and return (member name, filename, size) of
+    importable images. Folders are flattened into one gallery folder, so
+    images that share a name in different folders get a numbered suffix
+    (`a/IMG_1.jpg`, `b/IMG_1.jpg` -> `IMG_1.jpg`, `IMG_1-2.jpg`).
+    Nothing is decompressed here; members are streamed one at a time by the jobs.
+    """
+    members = []
+    with _open_archive(archive_path, kind) as archive:
+        if kind == "zip":
+            entries = [(info.filename, info.file_size) for info in archive.infolist() if not info.is_dir()]
+        else:
+            entries = [(info.name, info.size) for info in archive if info.isfile()]
+
+    seen_members = set()
+    taken = set()
+    for name, size in entries:
+        basename = os.path.basename(name)
+        if name.startswith("__MACOSX/") or basename.startswith("."):
+            continue
+        if not any(basename.lower().endswith(ext) for ext in IMPORT_FORMATS):
+            continue
+        # An archive can hold the same path twice; only one can be read back by name
+        if name in seen_members:
+            continue
+        seen_members.add(name)
+
+        filename = secure_filename(basename)
+        if filename:
+            stem, ext = os.path.splitext(filename)
+            counter = 1
+            while filename.lower() in taken:
+                counter += 1
+                filename = f"{stem}-{counter}{ext}"
+            taken.add(filename.lower())
+        members.append((name, filename, size))
+
+    return members
+
+
+@frappe.whitelist()
+def import_archive(service_id, folder_type):
+    """
+    API endpoint to import a ZIP or tar archive of images into a gallery folder.
+    Members are processed by background jobs; poll get_import_progress with the
+    returned import_id.
+    """
+    archive_path = None
+    try:
+        validate_target(service_id, folder_type)
+
+        archive = frappe.request.files.get('archive') if frappe.request.files else None
+        if not archive:
+            frappe.throw(_("No archive file provided"))
+
+        max_archive_bytes = int(frappe.conf.get("gallery_import_max_bytes") or DEFAULT_MAX_ARCHIVE_BYTES)
+        archive_path, _digest, _size = stream_to_temp(archive.stream, max_bytes=max_archive_bytes)
+
+        if zipfile.is_zipfile(archive_path):
+            kind = "zip"
+        elif tarfile.is_tarfile(archive_path):
+            kind = "tar"
+        else:
+            frappe.throw(_("File must be a ZIP or tar archive"))
+
+        members = _list_members(archive_path, kind)
+        if not members:
+            frappe.throw(_("Archive contains no supported images"))
+
+        max_files = int(frappe.conf.get("gallery_import_max_files") or DEFAULT_MAX_FILES)
+        if len(members) > max_files:
+            frappe.throw(_("Archive contains {0} images, the limit is {1}").format(len(members), max_files))
+
+        import_id = uuid.uuid4().hex
+        if kind == "zip":
+            batch_size = int(frappe.conf.get("gallery_import_batch_size") or DEFAULT_BATCH_SIZE)
+            batches = [members[i:i + batch_size] for i in range(0, len(members), batch_size)]
+        else:
+            # A (usually compressed) tar can only be read front to back, so
+            # one job streams it once instead of every batch decompressing it again
+            batches = [members]
+
+        frappe.cache().set_value(_meta_key(import_id), {
+            "owner": frappe.session.user,
+            "service_id": service_id,
+            "folder_type": folder_type,
+            "archive_path": archive_path,
+            "kind": kind,
+            "total": len(members),
+            "created_at": now_datetime().isoformat()
+        }, expires_in_sec=IMPORT_TTL)
+        frappe.cache().set(_pending_key(import_id), len(batches), ex=IMPORT_TTL)
+
+        for index, batch in enumerate(batches):
+            frappe.enqueue(
+                method="gallery_protection.api.bulk_import.process_import_batch",
+                queue="long",
+                job_name=f"Gallery import {import_id} batch {index + 1}/{len(batches)}",
+                now=False,
+                import_id=import_id,
+                members=[(name, filename) for name, filename, size in batch]
+            )
+
+        return {
+            "success": True,
+            "message": f"Queued {len(members)} images for import",
+            "import_id": import_id,
+            "total": len(members),
+            "batches": len(batches)
+        }
+
+    except Exception as e:
+        if archive_path:
+            _remove_quietly(archive_path)
+        frappe.log_error(f"Error in import_archive: {str(e)}")
+        return {"success": False, "message": "Error importing archive", "error": str(e)}
+
+
+def process_import_batch(import_id, members):
+    """
+    Background job: import a batch of archive members, recording a result per file
+    """
+    meta = frappe.cache().get_value(_meta_key(import_id), expires=True)
+    if not meta:
+        return
+
+    try:
+        validate_target(meta["service_id"], meta["folder_type"])
+        with _open_archive(meta["archive_path"], meta["kind"]) as archive:
+            if meta["kind"] == "zip":
+                entries = [(member, member, filename) for member, filename in members]
+            else:
+                entries = _iter_tar_members(archive, members)
+            for member, entry, filename in entries:
+                result = _import_member(archive, meta, entry, filename)
+                frappe.cache().hset(_results_key(import_id), member, result)
+        frappe.cache().expire(frappe.cache().make_key(_results_key(import_id)), IMPORT_TTL)
+    finally:
+        if frappe.cache().decr(_pending_key(import_id)) <= 0:
+            _remove_quietly(meta["archive_path"])
+
+
+def _iter_tar_members(archive, members):
+    """
+    Walk the tar in archive order, yielding (name, TarInfo, filename) for the
+    wanted members, so each is read where the stream already is
+    """
+    wanted = dict(members)
+    for info in archive:
+        filename = wanted.pop(info.name, None)
+        if filename is not None and info.isfile():
+            yield info.name, info, filename
+            if not wanted:
+                return
+    for name, filename in wanted.items():
+        yield name, name, filename
+
+
+def _import_member(archive, meta, member, filename):
+    temp_path = None
+    try:
+        if not filename:
+            frappe.throw(_("Invalid filename"))
+
+        if meta["kind"] == "zip":
+            stream = archive.open(member)
+        else:
+            stream = archive.extractfile(member)
+
+        with stream:
+            temp_path, digest, size = stream_to_temp(stream)
+
+        result = ingest_image(temp_path, digest, meta["service_id"], meta["folder_type"], filename)
+        temp_path = None
+
+        if meta["folder_type"] == "gallery":
+            storage = get_storage()
+            image_key = result["key"]
+            image_stat = storage.stat(image_key)
+            key, profile, limits = get_watermark_render(meta["service_id"], image_key, image_stat)
+            get_or_render(key, render_stored_image, storage, image_key, image_stat, profile, limits)
+
+        return {"success": True, "filename": filename, "size": size, "deduplicated": result["deduplicated"], "duplicates": result["duplicates"]}
+
+    except Exception as e:
+        return {"success": False, "filename": filename or os.path.basename(getattr(member, "name", member)), "error": str(e)}
+    finally:
+        if temp_path:
+            _remove_quietly(temp_path)
+
+
+@frappe.whitelist()
+def get_import_progress(import_id, include_results=0):
+    """
+    API endpoint to get progress of an archive import
+    """
+    try:
+        meta = frappe.cache().get_value(_meta_key(import_id), expires=True)
+        if not meta or meta.get("owner") != frappe.session.user:
+            return {"success": False, "message": "Import not found or expired"}
+
+        results = frappe.cache().hgetall(_results_key(import_id)) or {}
+        succeeded = sum(1 for r in results.values() if r.get("success"))
+        processed = len(results)
+
+        response = {
+            "success": True,
+            "import_id": import_id,
+            "service_id": meta["service_id"],
+            "folder_type": meta["folder_type"],
+            "total": meta["total"],
+            "processed": processed,
+            "succeeded": succeeded,
+            "failed": processed - succeeded,
+            "status": "completed" if processed >= meta["total"] else "in_progress"
+        }
+        if frappe.utils.cint(include_results):
+            response["results"] = {
+                (name.decode() if isinstance(name, bytes) else name): result
+                for name, result in results.items()
+            }
+        return response
+
+    except Exception as e:
+        frappe.log_error(f"Error in get_import_progress: {str(e)}")
+        return {"success": False, "message": "Error retrieving import progress", "error": str(e)}
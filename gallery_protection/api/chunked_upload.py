@@ -0,0 +1,236 @@
+import frappe
+import hashlib
+import threading
+import uuid
+from collections import OrderedDict
+from frappe import _
+from frappe.utils import now_datetime
+from werkzeug.utils import secure_filename
+from .normalizer import ingest_image
+from .image_store import (
+    COPY_BUFFER_SIZE, DEFAULT_UPLOAD_TTL, validate_target, new_temp_path,
+    get_max_upload_bytes, hash_file, _remove_quietly
+)
+
+DEFAULT_MAX_CHUNK_BYTES = 8 * 1024 * 1024
+MAX_TRACKED_HASHERS = 64
+
+# upload_id -> (offset, hasher) for uploads whose chunks landed on this worker
+_hashers = OrderedDict()
+_hashers_lock = threading.Lock()
+
+
+def _state_key(upload_id):
+    return f"gallery_upload:{upload_id}"
+
+
+def _get_state(upload_id):
+    state = frappe.cache().get_value(_state_key(upload_id), expires=True)
+    if not state or state.get("owner") != frappe.session.user:
+        frappe.throw(_("Upload not found or expired"), frappe.DoesNotExistError)
+    return state
+
+
+def _save_state(upload_id, state):
+    frappe.cache().set_value(
+        _state_key(upload_id), state,
+        expires_in_sec=int(frappe.conf.get("gallery_upload_ttl") or DEFAULT_UPLOAD_TTL)
+    )
+
+
+def _upload_lock(upload_id):
+    cache = frappe.cache()
+    return cache.lock(cache.make_key(f"gallery_upload_lock:{upload_id}"), timeout=60, blocking_timeout=10)
+
+
+def _take_hasher(upload_id, offset):
+    """
+    Return the running hasher for an upload if this worker saw every byte so far
+    """
+    with _hashers_lock:
+        entry = _hashers.pop(upload_id, None)
+    if entry and entry[0] == offset:
+        return entry[1]
+    if offset == 0:
+        return hashlib.sha256()
+    return None
+
+
+def _keep_hasher(upload_id, offset, hasher):
+    with _hashers_lock:
+        _hashers[upload_id] = (offset, hasher)
+        while len(_hashers) > MAX_TRACKED_HASHERS:
+            _hashers.popitem(last=False)
+
+
+def _status(upload_id, state):
+    return {
+        "upload_id": upload_id,
+        "filename": state["filename"],
+        "service_id": state["service_id"],
+        "folder_type": state["folder_type"],
+        "total_size": state["total_size"],
+        "received": state["received"],
+        "chunk_size": int(frappe.conf.get("gallery_upload_max_chunk_bytes") or DEFAULT_MAX_CHUNK_BYTES)
+    }
+
+
+@frappe.whitelist()
+def init_upload(service_id, folder_type, filename, total_size):
+    """
+    API endpoint to start a chunked image upload
+    """
+    try:
+        validate_target(service_id, folder_type)
+
+        secure_name = secure_filename(filename)
+        if not secure_name:
+            frappe.throw(_("Invalid filename"))
+
+        total_size = int(total_size)
+        max_bytes = get_max_upload_bytes()
+        if total_size <= 0 or total_size > max_bytes:
+            frappe.throw(_("File size must be between 1 and {0} bytes").format(max_bytes))
+
+        upload_id = uuid.uuid4().hex
+        temp_path = new_temp_path()
+        open(temp_path, 'wb').close()
+
+        state = {
+            "owner": frappe.session.user,
+            "service_id": service_id,
+            "folder_type": folder_type,
+            "filename": secure_name,
+            "total_size": total_size,
+            "received": 0,
+            "temp_path": temp_path,
+            "created_at": now_datetime().isoformat()
+        }
+        _save_state(upload_id, state)
+
+        return {"success": True, "message": "Upload started", **_status(upload_id, state)}
+
+    except Exception as e:
+        frappe.log_error(f"Error in init_upload: {str(e)}")
+        return {"success": False, "message": "Error starting upload", "error": str(e)}
+
+
+@frappe.whitelist()
+def upload_chunk(upload_id, offset):
+    """
+    API endpoint to append a chunk (form file `chunk`) at `offset` of an upload.
+    A mismatched offset is rejected with the offset the server expects, so
+    clients can resume after a dropped connection.
+    """
+    try:
+        offset = int(offset)
+        chunk = frappe.request.files.get('chunk') if frappe.request.files else None
+        if not chunk:
+            frappe.throw(_("No chunk provided"))
+
+        with _upload_lock(upload_id):
+            state = _get_state(upload_id)
+            if offset != state["received"]:
+                return {
+                    "success": False,
+                    "message": "Offset mismatch, resume from the expected offset",
+                    **_status(upload_id, state)
+                }
+
+            max_chunk = int(frappe.conf.get("gallery_upload_max_chunk_bytes") or DEFAULT_MAX_CHUNK_BYTES)
+            remaining = state["total_size"] - offset
+            hasher = _take_hasher(upload_id, offset)
+            written = 0
+
+            with open(state["temp_path"], 'r+b') as f:
+                f.seek(offset)
+                f.truncate()
+                while True:
+                    data = chunk.stream.read(COPY_BUFFER_SIZE)
+                    if not data:
+                        break
+                    written += len(data)
+                    if written > max_chunk or written > remaining:
+                        f.truncate(offset)
+                        frappe.throw(_("Chunk exceeds the allowed size"))
+                    if hasher:
+                        hasher.update(data)
+                    f.write(data)
+
+            state["received"] = offset + written
+            _save_state(upload_id, state)
+            if hasher:
+                _keep_hasher(upload_id, state["received"], hasher)
+
+        return {"success": True, "message": "Chunk received", **_status(upload_id, state)}
+
+    except Exception as e:
+        frappe.log_error(f"Error in upload_chunk: {str(e)}")
+        return {"success": False, "message": "Error uploading chunk", "error": str(e)}
+
+
+@frappe.whitelist()
+def get_upload_status(upload_id):
+    """
+    API endpoint to get how many bytes of an upload the server has
+    """
+    try:
+        state = _get_state(upload_id)
+        return {"success": True, **_status(upload_id, state)}
+    except Exception as e:
+        return {"success": False, "message": "Upload not found or expired", "error": str(e)}
+
+
+@frappe.whitelist()
+def finalize_upload(upload_id):
+    """
+    API endpoint to complete a chunked upload and publish the image
+    """
+    try:
+        with _upload_lock(upload_id):
+            state = _get_state(upload_id)
+            if state["received"] != state["total_size"]:
+                frappe.throw(_("Upload incomplete: received {0} of {1} bytes").format(state["received"], state["total_size"]))
+
+            validate_target(state["service_id"], state["folder_type"])
+            hasher = _take_hasher(upload_id, state["received"])
+            digest = hasher.hexdigest() if hasher else hash_file(state["temp_path"])
+
+            # The temp file is consumed even if it turns out not to be an image
+            frappe.cache().delete_value(_state_key(upload_id))
+            result = ingest_image(state["temp_path"], digest, state["service_id"], state["folder_type"], state["filename"])
+
+        service_id, folder_type, filename = state["service_id"], state["folder_type"], state["filename"]
+        return {
+            "success": True,
+            "message": "Image uploaded successfully",
+            "filename": filename,
+            "service_id": service_id,
+            "folder_type": folder_type,
+            "content_hash": digest,
+            "deduplicated": result["deduplicated"],
+            "duplicates": result["duplicates"],
+            "url": f"/api/method/gallery_protection.api.gallery_api.serve_image?service_id={service_id}&folder_type={folder_type}&image_name={filename}"
+        }
+
+    except Exception as e:
+        frappe.log_error(f"Error in finalize_upload: {str(e)}")
+        return {"success": False, "message": "Error finalizing upload", "error": str(e)}
+
+
+@frappe.whitelist()
+def abort_upload(upload_id):
+    """
+    API endpoint to cancel a chunked upload and discard what was received
+    """
+    try:
+        with _upload_lock(upload_id):
+            state = _get_state(upload_id)
+            _remove_quietly(state["temp_path"])
+            frappe.cache().delete_value(_state_key(upload_id))
+        with _hashers_lock:
+            _hashers.pop(upload_id, None)
+        return {"success": True, "message": "Upload aborted"}
+    except Exception as e:
+        frappe.log_error(f"Error in abort_upload: {str(e)}")
+        return {"success": False, "message": "Error aborting upload", "error": str(e)}
@@ -1,12 +1,67 @@
-
 from frappe.handler import handle
 from frappe import _
+from werkzeug.wrappers import Response
+import frappe
+
+ALLOWED_METHODS = "GET, POST, OPTIONS"
+ALLOWED_HEADERS = "Content-Type, Authorization, X-Session-Token, Range"
+EXPOSED_HEADERS = "Content-Length, Content-Disposition, Content-Range, Accept-Ranges, Retry-After"
+DEFAULT_MAX_AGE = 86400
+
+# (configured origins, frozenset of them), rebuilt only when site config changes
+_allowed_origins = (None, frozenset())
+
+
+def get_allowed_origins():
+    global _allowed_origins
+    configured = tuple(frappe.conf.get("gallery_cors_allowed_origins") or ("*",))
+    if _allowed_origins[0] != configured:
+        _allowed_origins = (configured, frozenset(origin.rstrip("/") for origin in configured))
+    return _allowed_origins[1]
+
+
+def get_cors_headers(origin):
+    """
+    CORS headers for a request from `origin`; empty if the origin is not allowed
+    """
+    allowed = get_allowed_origins()
+    if "*" in allowed:
+        allow_origin = "*"
+    elif origin and origin in allowed:
+        allow_origin = origin
+    else:
+        return {}
+
+    return {
+        "Access-Control-Allow-Origin": allow_origin,
+        "Access-Control-Allow-Methods": ALLOWED_METHODS,
+        "Access-Control-Allow-Headers": ALLOWED_HEADERS,
+        "Access-Control-Expose-Headers": EXPOSED_HEADERS,
+        "Access-Control-Max-Age": str(int(frappe.conf.get("gallery_cors_max_age") or DEFAULT_MAX_AGE)),
+        "Vary": "Origin",
+    }
+
+
+def apply_cors_headers(response, origin=None):
+    """
+    Add CORS headers to a response for the current request's origin
+    """
+    if origin is None:
+        origin = frappe.get_request_header("Origin")
+    response.headers.update(get_cors_headers(origin))
+    return response
+
+
+def preflight_response(origin):
+    return Response(status=204, headers=get_cors_headers(origin))
+
 
 def cors_handler():
     from frappe import local
-    response = handle()
-    if local.response:
-        local.response.headers["Access-Control-Allow-Origin"] = "*"
-        local.response.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
-        local.response.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
-    return response
\ No newline at end of file
+    origin = local.request.headers.get("Origin")
+
+    # Preflights only need headers: answer them without dispatching into Frappe
+    if local.request.method == "OPTIONS":
+        return preflight_response(origin)
+
+    return apply_cors_headers(handle(), origin)
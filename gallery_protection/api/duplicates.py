@@ -0,0 +1,277 @@
+import frappe
+import pickle
+import threading
+from frappe import _
+from .image_store import validate_target
+from .storage import get_storage, get_image_key
+
+DEFAULT_DUPLICATE_DISTANCE = 6
+DUPLICATE_ACTIONS = ("flag", "reject", "off")
+# Field present in a folder's Redis hash once it has been seeded from storage
+SEEDED_FIELD = ""
+
+# (site, service_id, folder_type) -> DuplicateIndex of this process
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def _hashes_key(service_id, folder_type):
+    return f"gallery_dhash:{service_id}:{folder_type}"
+
+
+def _generation_key(service_id, folder_type):
+    return frappe.cache().make_key(f"gallery_dhash_generation:{service_id}:{folder_type}")
+
+
+def get_duplicate_distance():
+    return int(frappe.conf.get("gallery_duplicate_distance") or DEFAULT_DUPLICATE_DISTANCE)
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over 64-bit hashes with Hamming distance. Each node
+    is [hash, names, {distance: child}]; a search only descends into children
+    whose edge distance is within `max_distance` of the query's distance to
+    the node, so lookups touch a small part of the tree.
+    """
+    def __init__(self):
+        self.root = None
+
+    def add(self, value, name):
+        if self.root is None:
+            self.root = [value, {name}, {}]
+            return
+        node = self.root
+        while True:
+            distance = (node[0] ^ value).bit_count()
+            if distance == 0:
+                node[1].add(name)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, {name}, {}]
+                return
+            node = child
+
+    def remove(self, value, name):
+        # Nodes stay in place as routing points; only the name goes
+        node = self.root
+        while node is not None:
+            distance = (node[0] ^ value).bit_count()
+            if distance == 0:
+                node[1].discard(name)
+                return
+            node = node[2].get(distance)
+
+    def search(self, value, max_distance):
+        """
+        Yield (name, distance) of every entry within `max_distance` of `value`
+        """
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = (node[0] ^ value).bit_count()
+            if distance <= max_distance:
+                for name in node[1]:
+                    yield name, distance
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+
+
+class DuplicateIndex:
+    """
+    Perceptual hashes of one gallery folder, searchable by Hamming distance
+    """
+    def __init__(self, generation, hashes, seeded=True):
+        self.generation = generation
+        self.seeded = seeded
+        self.hashes = {}
+        self.tree = BKTree()
+        for name, dhash in hashes.items():
+            self.add(name, dhash)
+
+    def add(self, name, dhash):
+        self.remove(name)
+        self.hashes[name] = dhash
+        self.tree.add(int(dhash, 16), name)
+
+    def remove(self, name):
+        dhash = self.hashes.pop(name, None)
+        if dhash:
+            self.tree.remove(int(dhash, 16), name)
+
+    def find(self, dhash, max_distance, exclude=None):
+        matches = [
+            {"name": name, "distance": distance}
+            for name, distance in self.tree.search(int(dhash, 16), max_distance)
+            if name != exclude
+        ]
+        return sorted(matches, key=lambda match: (match["distance"], match["name"]))
+
+
+def _seed_pending_key(service_id, folder_type):
+    return frappe.cache().make_key(f"gallery_dhash_seeding:{service_id}:{folder_type}")
+
+
+def _enqueue_seed(service_id, folder_type):
+    cache = frappe.cache()
+    if cache.set(_seed_pending_key(service_id, folder_type), 1, nx=True, ex=600):
+        frappe.enqueue(
+            method="gallery_protection.api.duplicates.seed_duplicate_index",
+            queue="long",
+            job_name=f"Seed duplicate index {service_id}/{folder_type}",
+            now=False,
+            service_id=service_id,
+            folder_type=folder_type
+        )
+
+
+def seed_duplicate_index(service_id, folder_type):
+    """
+    Background job: load a folder's perceptual hashes from the images'
+    metadata sidecars into Redis, computing those missing from sidecars
+    written before perceptual hashing
+    """
+    # Imported here as the normalizer checks uploads through this module
+    from .normalizer import get_folder_meta, refresh_image_meta
+
+    cache = frappe.cache()
+    try:
+        storage = get_storage()
+        images = list(storage.list_images(service_id, folder_type))
+        hashes = {}
+        for filename, meta in get_folder_meta(storage, service_id, folder_type, images).items():
+            if not meta.get("dhash"):
+                meta = refresh_image_meta(storage, get_image_key(service_id, folder_type, filename)) or {}
+            if meta.get("dhash"):
+                hashes[filename] = meta["dhash"]
+        hashes[SEEDED_FIELD] = ""
+
+        pipe = cache.pipeline(transaction=False)
+        hashes_key = cache.make_key(_hashes_key(service_id, folder_type))
+        for name, dhash in hashes.items():
+            # Same encoding as frappe.cache().hset, so hgetall reads it back
+            pipe.hset(hashes_key, name, pickle.dumps(dhash))
+        pipe.incr(_generation_key(service_id, folder_type))
+        pipe.execute()
+    finally:
+        cache.delete(_seed_pending_key(service_id, folder_type))
+
+
+def get_duplicate_index(service_id, folder_type):
+    """
+    This process's index for a folder. Hashes are kept in a Redis hash and
+    every change bumps a generation counter; the in-memory tree is rebuilt
+    lazily when it is behind. When Redis has not been seeded for the folder
+    (first use, or the keys were evicted) a background job loads it from the
+    sidecars; until then only hashes recorded since are searched.
+    """
+    cache = frappe.cache()
+    index_key = (frappe.local.site, service_id, folder_type)
+    generation = cache.get(_generation_key(service_id, folder_type))
+
+    with _indexes_lock:
+        index = _indexes.get(index_key)
+    if index is not None and generation is not None and index.generation == int(generation):
+        return index
+
+    hashes = {
+        (name.decode() if isinstance(name, bytes) else name): dhash
+        for name, dhash in (cache.hgetall(_hashes_key(service_id, folder_type)) or {}).items()
+    }
+    seeded = hashes.pop(SEEDED_FIELD, None) is not None
+    if not seeded:
+        _enqueue_seed(service_id, folder_type)
+
+    index = DuplicateIndex(int(generation or 0), hashes, seeded)
+    with _indexes_lock:
+        _indexes[index_key] = index
+    return index
+
+
+def _apply_change(service_id, folder_type, change):
+    generation = frappe.cache().incr(_generation_key(service_id, folder_type))
+    with _indexes_lock:
+        index = _indexes.get((frappe.local.site, service_id, folder_type))
+        # Apply in place when ours is the only change since the last build
+        if index is not None and index.generation == generation - 1:
+            change(index)
+            index.generation = generation
+
+
+def record_image_hash(service_id, folder_type, filename, dhash):
+    if not dhash:
+        return
+    frappe.cache().hset(_hashes_key(service_id, folder_type), filename, dhash)
+    _apply_change(service_id, folder_type, lambda index: index.add(filename, dhash))
+
+
+def forget_image_hash(service_id, folder_type, filename):
+    frappe.cache().hdel(_hashes_key(service_id, folder_type), filename)
+    _apply_change(service_id, folder_type, lambda index: index.remove(filename))
+
+
+def check_duplicates(service_id, folder_type, filename, dhash):
+    """
+    Near-duplicates of an incoming image, handled per `gallery_duplicate_action`:
+    `flag` returns them, `reject` throws, `off` skips the lookup.
+    An image replacing one of the same name is not its own duplicate.
+    """
+    action = frappe.conf.get("gallery_duplicate_action") or "flag"
+    if action not in DUPLICATE_ACTIONS:
+        action = "flag"
+    if action == "off" or not dhash:
+        return []
+
+    matches = get_duplicate_index(service_id, folder_type).find(dhash, get_duplicate_distance(), exclude=filename)
+    if matches and action == "reject":
+        frappe.throw(_("Image is a near-duplicate of {0}").format(matches[0]["name"]))
+    return matches
+
+
+@frappe.whitelist()
+def find_duplicate_clusters(service_id, folder_type="gallery", distance=None):
+    """
+    API endpoint to group the images of a folder into clusters of near-duplicates
+    Requires System Manager
+    """
+    frappe.only_for("System Manager")
+    try:
+        validate_target(service_id, folder_type)
+        max_distance = frappe.utils.cint(distance) if distance not in (None, "") else get_duplicate_distance()
+        index = get_duplicate_index(service_id, folder_type)
+
+        # Union-find over every pair within max_distance
+        parent = {name: name for name in index.hashes}
+
+        def find_root(name):
+            while parent[name] != name:
+                parent[name] = parent[parent[name]]
+                name = parent[name]
+            return name
+
+        for name, dhash in index.hashes.items():
+            for match in index.find(dhash, max_distance, exclude=name):
+                parent[find_root(match["name"])] = find_root(name)
+
+        clusters = {}
+        for name in index.hashes:
+            clusters.setdefault(find_root(name), []).append(name)
+        clusters = sorted((sorted(names) for names in clusters.values() if len(names) > 1), key=len, reverse=True)
+
+        return {
+            "success": True,
+            "service_id": service_id,
+            "folder_type": folder_type,
+            "distance": max_distance,
+            "images": len(index.hashes),
+            # False while the folder's hashes are still being loaded
+            "complete": index.seeded,
+            "duplicates": sum(len(names) - 1 for names in clusters),
+            "clusters": clusters
+        }
+
+    except Exception as e:
+        frappe.log_error(f"Error in find_duplicate_clusters: {str(e)}")
+        return {"success": False, "message": "Error finding duplicates", "error": str(e)}
@@ -0,0 +1,60 @@
+"""
+Read-only, memory-mapped access to local files, for streaming responses.
+
+Mapped pages come straight from the OS page cache, which all worker
+processes share: sixteen workers streaming the same large original cost one
+copy in memory instead of one Python `bytes` per worker, and a byte range
+only touches the pages it covers. Response chunks are copied into `bytes`
+one chunk at a time, as WSGI needs them.
+
+Decoding does not go through here: Pillow's decoders (WebP reads the whole
+file with `fp.read()`) copy the encoded data whatever they are given, so
+images are opened from their path.
+
+Files are never modified in place (writers go through a temp file and
+`os.replace`), so a map always sees the complete version it was opened on.
+"""
+import mmap
+import os
+from contextlib import contextmanager
+
+RESPONSE_CHUNK_SIZE = 256 * 1024
+
+
+def _map(f):
+    # Zero-length files cannot be mapped
+    if os.fstat(f.fileno()).st_size == 0:
+        return None
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+@contextmanager
+def map_file(path):
+    """
+    Yield a read-only memoryview of the whole file. Slices taken from it
+    must not outlive the block.
+    """
+    with open(path, 'rb') as f:
+        mapped = _map(f)
+    if mapped is None:
+        yield memoryview(b"")
+        return
+
+    view = memoryview(mapped)
+    try:
+        yield view
+    finally:
+        view.release()
+        mapped.close()
+
+
+def iter_file(path, start=0, stop=None, chunk_size=RESPONSE_CHUNK_SIZE):
+    """
+    Yield the file's bytes from `start` up to (not including) `stop` in
+    chunks, for use as a streamed response body. The map is closed when the
+    iteration ends or the server closes the iterator.
+    """
+    with map_file(path) as view:
+        stop = len(view) if stop is None else min(stop, len(view))
+        for offset in range(start, stop, chunk_size):
+            yield bytes(view[offset:min(offset + chunk_size, stop)])
@@ -1,33 +1,251 @@
 import frappe
 from frappe import _
+import hashlib
 import json
+import os
+import threading
+import time
 from frappe.utils import now_datetime, format_datetime
+from jinja2 import Environment, FileSystemLoader
+from markupsafe import Markup
+from redis import Redis
+from redis.exceptions import LockError
+
+FORM_TEMPLATE = "form_template.html"
+DEFAULT_RECIPIENTS = ["contact@amanksolutions.com"]
+DEFAULT_MAX_BYTES = 16 * 1024
+DEFAULT_RATE_PER_MINUTE = 3
+DEFAULT_BURST = 5
+DEFAULT_DUPLICATE_TTL = 86400
+DEFAULT_DIGEST_WINDOW = 120
+DEFAULT_DIGEST_SIZE = 20
+DEFAULT_MAX_ATTEMPTS = 5
+# The queue lists are moved between with LMOVE, which RedisWrapper does not
+# wrap, so their keys are made once and every list command goes through the
+# plain redis methods; the wrapper's own rpush/llen/lrange would prefix again.
+QUEUE_KEY = "gallery_form_queue"
+PROCESSING_KEY = "gallery_form_processing"
+DEAD_LETTER_KEY = "gallery_form_dead_letter"
+FLUSH_PENDING_KEY = "gallery_form_flush_pending"
+
+# Refill the bucket for the time since the last request, then take a token.
+# Returns {1, 0} when allowed, {0, seconds until a token is available} otherwise.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+if allowed == 1 then
+    return {1, 0}
+end
+return {0, math.ceil((1 - tokens) / rate)}
+"""
+
+_template = None
+_template_lock = threading.Lock()
+
+
+def get_form_template():
+    """
+    The mail template, compiled once per process. Submitted values are
+    escaped, so markup typed into the form arrives as text.
+    """
+    global _template
+    if _template is None:
+        with _template_lock:
+            if _template is None:
+                environment = Environment(
+                    loader=FileSystemLoader(os.path.join(frappe.get_app_path('gallery_protection'), "templates", "email")),
+                    autoescape=True
+                )
+                _template = environment.get_template(FORM_TEMPLATE)
+    return _template
+
+
+def _take_token(client_ip):
+    """
+    Per-IP token bucket kept in Redis. Returns seconds to wait, 0 if allowed.
+    """
+    cache = frappe.cache()
+    rate = float(frappe.conf.get("gallery_form_rate_per_minute") or DEFAULT_RATE_PER_MINUTE) / 60
+    capacity = int(frappe.conf.get("gallery_form_burst") or DEFAULT_BURST)
+    allowed, retry_after = cache.eval(
+        TOKEN_BUCKET_SCRIPT, 1, cache.make_key(f"gallery_form_bucket:{client_ip}"),
+        rate, capacity, time.time()
+    )
+    return 0 if allowed else int(retry_after)
+
+
+def _content_hash(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
 
 @frappe.whitelist(allow_guest=True)
 def handle_form_submission():
 
-    data = frappe.request.get_json()
-    data["submitted_at"] = format_datetime(now_datetime(), "full")
+    max_bytes = int(frappe.conf.get("gallery_form_max_bytes") or DEFAULT_MAX_BYTES)
+    if (frappe.request.content_length or 0) > max_bytes or len(frappe.request.get_data()) > max_bytes:
+        frappe.local.response.http_status_code = 413
+        return {"status": "rejected", "message": "Form is too large."}
 
+    client_ip = frappe.local.request_ip or "unknown"
+    retry_after = _take_token(client_ip)
+    if retry_after:
+        frappe.local.response.http_status_code = 429
+        return {
+            "status": "rejected",
+            "message": "Too many submissions. Please try again later.",
+            "retry_after": retry_after
+        }
 
-    frappe.enqueue(
-        method="gallery_protection.api.form_handler.send_form_mail",
-        queue="short",  # or "default"
-        job_name="Send Contact Form Mail",
-        now=False,
-        data=data
-    )
+    data = frappe.request.get_json(silent=True)
+    if not isinstance(data, dict):
+        frappe.local.response.http_status_code = 400
+        return {"status": "rejected", "message": "Invalid form data."}
+
+    cache = frappe.cache()
+    duplicate_ttl = int(frappe.conf.get("gallery_form_duplicate_ttl") or DEFAULT_DUPLICATE_TTL)
+    # Repeats get the same answer as the first submission, but are not mailed again
+    if not cache.set(cache.make_key(f"gallery_form_seen:{_content_hash(data)}"), 1, nx=True, ex=duplicate_ttl):
+        return {"status": "queued", "message": "Form received. Thank you!"}
+
+    data["submitted_at"] = format_datetime(now_datetime(), "full")
+    queued = Redis.rpush(cache, cache.make_key(QUEUE_KEY), json.dumps({"data": data, "queued_at": time.time()}))
+
+    # A full batch is sent right away; smaller ones wait for the scheduled flush
+    if queued >= int(frappe.conf.get("gallery_form_digest_size") or DEFAULT_DIGEST_SIZE):
+        _enqueue_flush()
 
     return {"status": "queued", "message": "Form received. Thank you!"}
 
 
+def _enqueue_flush():
+    cache = frappe.cache()
+    if cache.set(cache.make_key(FLUSH_PENDING_KEY), 1, nx=True, ex=300):
+        frappe.enqueue(
+            method="gallery_protection.api.form_handler.flush_form_queue",
+            queue="short",
+            job_name="Send Contact Form Digest",
+            now=False,
+            force=True
+        )
+
+
+def flush_form_queue(force=False):
+    """
+    Scheduled job: mail queued submissions as digests of up to
+    `gallery_form_digest_size`, once the oldest has waited
+    `gallery_form_digest_window` seconds or a batch is full.
+
+    Each batch is moved to a processing list and only removed from it once
+    sent, so a crash mid-send leaves it to be retried by the next run. A batch
+    that keeps failing is retried up to `gallery_form_max_attempts` times and
+    then parked in the dead-letter list, so it cannot hold up newer mail.
+    """
+    cache = frappe.cache()
+    queue_key = cache.make_key(QUEUE_KEY)
+    processing_key = cache.make_key(PROCESSING_KEY)
+    batch_size = int(frappe.conf.get("gallery_form_digest_size") or DEFAULT_DIGEST_SIZE)
+    window = int(frappe.conf.get("gallery_form_digest_window") or DEFAULT_DIGEST_WINDOW)
+
+    try:
+        with cache.lock(cache.make_key("gallery_form_flush_lock"), timeout=120, blocking_timeout=0):
+            # Left behind by a run that died before acknowledging its batch
+            if Redis.llen(cache, processing_key):
+                _send_batch(cache, processing_key)
+
+            while True:
+                queued = Redis.llen(cache, queue_key)
+                if not queued:
+                    break
+                oldest = json.loads(Redis.lindex(cache, queue_key, 0))
+                if queued < batch_size and not force and time.time() - oldest["queued_at"] < window:
+                    break
+
+                pipe = cache.pipeline(transaction=True)
+                for _i in range(min(queued, batch_size)):
+                    pipe.lmove(queue_key, processing_key, "LEFT", "RIGHT")
+                pipe.execute()
+                _send_batch(cache, processing_key)
+    except LockError:
+        # Another worker is flushing and keeps going while full batches remain
+        pass
+    finally:
+        if force:
+            cache.delete(cache.make_key(FLUSH_PENDING_KEY))
+
+
+def _send_batch(cache, processing_key):
+    """
+    Send the batch in the processing list and clear it. On failure the batch
+    goes back to the head of the queue with its attempt count raised, or to
+    the dead-letter list once it has used up its attempts.
+    """
+    items = [json.loads(item) for item in Redis.lrange(cache, processing_key, 0, -1)]
+    try:
+        send_form_digest([item["data"] for item in items])
+    except Exception:
+        max_attempts = int(frappe.conf.get("gallery_form_max_attempts") or DEFAULT_MAX_ATTEMPTS)
+        retry, dead = [], []
+        for item in items:
+            item["attempts"] = item.get("attempts", 0) + 1
+            (dead if item["attempts"] >= max_attempts else retry).append(json.dumps(item))
+
+        pipe = cache.pipeline(transaction=True)
+        if retry:
+            # Back in front in their original order; a later run tries again
+            pipe.lpush(cache.make_key(QUEUE_KEY), *reversed(retry))
+        if dead:
+            pipe.rpush(cache.make_key(DEAD_LETTER_KEY), *dead)
+        pipe.delete(processing_key)
+        pipe.execute()
+        if dead:
+            frappe.log_error(f"{len(dead)} contact form submissions moved to {DEAD_LETTER_KEY} after {max_attempts} failed attempts")
+        raise
+    # The digest is only queued in the Email Queue so far; it has to be
+    # committed before the batch is acknowledged, or a rollback loses it
+    frappe.db.commit()
+    cache.delete(processing_key)
+
+
+def render_form_mail(data):
+    return get_form_template().render(data)
+
+
+def send_form_digest(batch):
+    """
+    One mail for a batch of submissions; a batch of one reads like the
+    original per-submission mail
+    """
+    if len(batch) == 1:
+        return send_form_mail(batch[0])
+
+    sections = [Markup(render_form_mail(data)) for data in batch]
+    html_body = Markup(f"<h2>{len(batch)} new contact requests</h2>") + Markup("<hr>").join(sections)
+
+    frappe.sendmail(
+        recipients=frappe.conf.get("gallery_form_recipients") or DEFAULT_RECIPIENTS,
+        subject=f"{len(batch)} New Contact Requests",
+        message=str(html_body),
+    )
+
+
 def send_form_mail(data):
 
-    html_body = frappe.render_template("gallery_protection/templates/email/form_template.html", data)
+    html_body = render_form_mail(data)
 
     frappe.sendmail(
-        recipients=["contact@amanksolutions.com"],
-        subject=f"New Contact Request on {data['leadCompany']}",
+        recipients=frappe.conf.get("gallery_form_recipients") or DEFAULT_RECIPIENTS,
+        subject=f"New Contact Request on {data.get('leadCompany')}",
         message=html_body,
     )
-
@@ -1,14 +1,19 @@
 import frappe
-import os
 from frappe import _
-from frappe.utils.file_manager import get_file_path
 from werkzeug.wrappers import Response
 from werkzeug.utils import secure_filename
-import mimetypes
+from werkzeug.http import parse_range_header
 import warnings
 from .session_manager import validate_viewing_session_internal, increment_session_usage
-from .watermarker import add_watermark, add_watermark_half
-# import magic
+from .watermarker import get_watermark_profile, get_render_limits, get_render_variant, render_watermark, ImageTooLarge
+from .render_pool import RenderPoolSaturated
+from .render_cache import get_or_render, make_render_key
+from .cors_handler import apply_cors_headers
+from .popularity import record_hit
+from .image_store import validate_target, stream_to_temp
+from .normalizer import ingest_image, get_render_source, get_folder_meta, remove_derived, sniff_format, HEADER_SIZE
+from .storage import get_storage, get_image_key
+from .duplicates import forget_image_hash
 
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
@@ -51,45 +56,40 @@ def _get_images(service_id=None, folder_type='gallery'):
     """
     Helper function to get gallery images
     """
-    private_path = frappe.get_site_path("private", "files", "images")
+    storage = get_storage()
     images = []
     supported_formats = ['.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.svg']
 
-    def process_directory(directory_path, service_name):
-        if not os.path.exists(directory_path):
-            return
-
-        for filename in os.listdir(directory_path):
-            if any(filename.lower().endswith(ext) for ext in supported_formats):
-                file_path = os.path.join(directory_path, filename)
-                if os.path.isfile(file_path):
-                    file_stat = os.stat(file_path)
-                    images.append({
-                        "name": filename,
-                        "service_id": service_name,
-                        "size": file_stat.st_size,
-                        "modified": file_stat.st_mtime,
-                        "url": f"/api/method/gallery_protection.api.gallery_api.serve_image?service_id={service_name}&folder_type={folder_type}&image_name={filename}"
-                    })
+    def process_folder(service_name):
+        folder_images = [
+            (filename, image_stat)
+            for filename, image_stat in storage.list_images(service_name, folder_type)
+            if any(filename.lower().endswith(ext) for ext in supported_formats)
+        ]
+        metas = get_folder_meta(storage, service_name, folder_type, folder_images)
+        for filename, image_stat in folder_images:
+            meta = metas.get(filename) or {}
+            images.append({
+                "name": filename,
+                "service_id": service_name,
+                "size": image_stat["size"],
+                "modified": image_stat["modified"],
+                "width": meta.get("width"),
+                "height": meta.get("height"),
+                "dominant_color": meta.get("dominant_color"),
+                "lqip": meta.get("lqip"),
+                "url": f"/api/method/gallery_protection.api.gallery_api.serve_image?service_id={service_name}&folder_type={folder_type}&image_name={filename}"
+            })
 
     if service_id:
         secure_service_id = secure_filename(service_id)
         if not secure_service_id or secure_service_id != service_id:
             frappe.throw(_("Invalid service ID"))
         
-        gallery_path = os.path.join(private_path, secure_service_id, folder_type)
-        process_directory(gallery_path, service_id)
+        process_folder(service_id)
     else:
-        if not os.path.exists(private_path):
-            return images
-        
-        for service_name in os.listdir(private_path):
-            service_path = os.path.join(private_path, service_name)
-            if not os.path.isdir(service_path):
-                continue
-            
-            gallery_path = os.path.join(service_path, folder_type)
-            process_directory(gallery_path, service_name)
+        for service_name in storage.list_services():
+            process_folder(service_name)
 
     return images
 
@@ -171,6 +171,112 @@ def get_half_gallery_images_by_id(**kwargs):
         frappe.log_error(f"Error in get_half_gallery_images_by_id: {str(e)}")
         return {"success": False, "message": "Error retrieving half gallery images", "error": str(e)}
 
+def resolve_image_path(service_id, folder_type, image_name):
+    """
+    Validate request parameters and return (storage key, safe file name, stat)
+    of the image. Shared with the standalone image server.
+    """
+    secure_service_id = secure_filename(service_id)
+    secure_folder_type = secure_filename(folder_type)
+    secure_name = secure_filename(image_name)
+    
+    if not secure_service_id or secure_service_id != service_id:
+        frappe.throw("Invalid service ID")
+    
+    if secure_folder_type not in ['gallery', 'galleryHalf']:
+        frappe.throw("Invalid folder type.")
+    
+    if not secure_name:
+        frappe.throw("Invalid image name")
+
+    # Keys are built from sanitized parts only, so they cannot leave the folder
+    if secure_name != image_name:
+        frappe.throw("Image not found", frappe.DoesNotExistError)
+
+    image_key = get_image_key(secure_service_id, secure_folder_type, secure_name)
+    image_stat = get_storage().stat(image_key)
+    if not image_stat:
+        frappe.throw("Image not found", frappe.DoesNotExistError)
+
+    return image_key, secure_name, image_stat
+
+def get_watermark_render(service_id, image_key, image_stat):
+    """
+    Profile, limits and render cache key for the watermarked variant of an image
+    """
+    profile = get_watermark_profile(service_id)
+    limits = get_render_limits()
+    return make_render_key(image_key, get_render_variant(profile, limits), image_stat["version"]), profile, limits
+
+def render_stored_image(storage, image_key, image_stat, profile, limits):
+    """
+    Render the watermarked variant of a stored image. Runs on the render pool,
+    so remote images are only fetched on a render cache miss.
+    """
+    # Uploads are sniffed and normalized at ingest; render from the master
+    source_key = get_render_source(storage, image_key, image_stat)
+    return render_watermark(storage.local_path(source_key), profile, limits)
+
+def load_image_content(service_id, folder_type, image_key, image_stat):
+    """
+    Return (bytes, mimetype) to deliver for a resolved image
+    """
+    storage = get_storage()
+
+    if folder_type == "gallery":
+        key, profile, limits = get_watermark_render(service_id, image_key, image_stat)
+        file_content = get_or_render(key, render_stored_image, storage, image_key, image_stat, profile, limits)
+    else:
+        file_content = storage.read(get_render_source(storage, image_key, image_stat))
+    #   file_content = add_watermark_half(real_image_path)
+
+    return file_content, get_image_mimetype(file_content)
+
+def open_image_stream(image_key, image_stat, secure_name, range_header=None):
+    """
+    Stream a raw (unwatermarked) image from storage, honouring a single byte
+    range. Returns (status, headers, mimetype, iterator of bytes chunks).
+    Shared with the standalone image server.
+    """
+    storage = get_storage()
+    source_key = get_render_source(storage, image_key, image_stat)
+    source_stat = image_stat if source_key == image_key else storage.stat(source_key)
+    size = source_stat["size"]
+
+    status, start, stop = 200, 0, size
+    headers = image_response_headers(secure_name, size)
+    headers['Accept-Ranges'] = 'bytes'
+    byte_range = parse_range_header(range_header)
+    span = byte_range.range_for_length(size) if byte_range else None
+    if span:
+        status, (start, stop) = 206, span
+        headers['Content-Range'] = f"bytes {start}-{stop - 1}/{size}"
+        headers['Content-Length'] = str(stop - start)
+
+    if source_key != image_key:
+        # Masters are always written as WebP
+        mimetype = "image/webp"
+    else:
+        mimetype = get_image_mimetype(b"".join(storage.iter_range(source_key, 0, HEADER_SIZE)))
+    return status, headers, mimetype, storage.iter_range(source_key, start, stop)
+
+def stream_image_response(image_key, image_stat, secure_name):
+    status, headers, mimetype, chunks = open_image_stream(
+        image_key, image_stat, secure_name, frappe.get_request_header("Range")
+    )
+    return Response(chunks, status=status, mimetype=mimetype, headers=headers, direct_passthrough=True)
+
+def get_image_mimetype(file_content):
+    image_format = sniff_format(file_content[:HEADER_SIZE])
+    return f"image/{image_format.lower()}" if image_format else "application/octet-stream"
+
+def image_response_headers(secure_name, content_length):
+    return {
+        'Content-Disposition': f'inline; filename="{secure_name}"',
+        'Cache-Control': 'public, max-age=31536000',
+        'Content-Length': str(content_length)
+    }
+
 @frappe.whitelist(allow_guest=True)
 @require_viewing_session
 def serve_image(**kwargs):
@@ -184,59 +290,32 @@ def serve_image(**kwargs):
     if not all([service_id, folder_type, image_name]):
         frappe.throw("Missing required parameters")
     try:
-        secure_service_id = secure_filename(service_id)
-        secure_folder_type = secure_filename(folder_type)
-        secure_name = secure_filename(image_name)
-        
-        if not secure_service_id or secure_service_id != service_id:
-            frappe.throw("Invalid service ID")
-        
-        if secure_folder_type not in ['gallery', 'galleryHalf']:
-            frappe.throw("Invalid folder type.")
-        
-        if not secure_name:
-            frappe.throw("Invalid image name")
-        
-        private_path = frappe.get_site_path("private", "files", "images")
-        image_path = os.path.join(private_path, secure_service_id, secure_folder_type, image_name)
-        
-        real_image_path = os.path.realpath(image_path)
-        real_folder_path = os.path.realpath(os.path.join(private_path, secure_service_id, secure_folder_type))
-
-        if not os.path.exists(real_image_path) or not real_image_path.startswith(real_folder_path + os.sep):
-            frappe.throw("Image not found")
-        
-        if not os.path.isfile(real_image_path):
-            frappe.throw("Invalid image file")
-        
-        # mime_type = magic.from_file(real_image_path, mime=True)
-        # if not mime_type or not mime_type.startswith('image/'):
-        #    frappe.throw("File is not a valid image")
-
-        mime_type = real_image_path.split(".")[-1]
-        print(f"mime type: {mime_type}")
-
-        if secure_folder_type == "gallery":
-            file_content = add_watermark(real_image_path)
+        image_key, secure_name, image_stat = resolve_image_path(service_id, folder_type, image_name)
+        if folder_type == "gallery":
+            file_content, mimetype = load_image_content(service_id, folder_type, image_key, image_stat)
+            response = Response(
+                file_content,
+                mimetype=mimetype,
+                headers=image_response_headers(secure_name, len(file_content))
+            )
         else:
-            with open(real_image_path, 'rb') as f:
-                file_content = f.read()
-    #       file_content = add_watermark_half(real_image_path)
+            response = stream_image_response(image_key, image_stat, secure_name)
+        record_hit(service_id, folder_type, secure_name)
+        return apply_cors_headers(response)
         
-        response = Response(
-            file_content,
-            # mimetype="image/"+mime_type,
-            mimetype="image/webp",
+    except RenderPoolSaturated as e:
+        return apply_cors_headers(Response(
+            str(e),
+            status=503,
+            mimetype="text/plain",
             headers={
-                'Content-Disposition': f'inline; filename="{secure_name}"',
-                'Cache-Control': 'public, max-age=31536000',
-                'Content-Length': str(len(file_content)),
-                #'Access-Control-Allow-Origin': '*',  # for CORS
-                'Access-Control-Allow-Headers': 'Content-Type, X-Session-Token'
+                'Retry-After': str(e.retry_after),
+                'Cache-Control': 'no-store'
             }
-        )
-        return response
-        
+        ))
+    except ImageTooLarge as e:
+        frappe.local.response.http_status_code = 422
+        return {"error": "Image too large to render", "description": str(e)}
     except frappe.DoesNotExistError:
         frappe.local.response.http_status_code = 404
         return {"error": "Image not found"}
@@ -251,14 +330,7 @@ def upload_image(service_id, folder_type):
     API endpoint to upload images to the gallery
     """
     try:
-        secure_service_id = secure_filename(service_id)
-        secure_folder_type = secure_filename(folder_type)
-        
-        if not secure_service_id or secure_service_id != service_id:
-            frappe.throw(_("Invalid service ID"))
-        
-        if secure_folder_type not in ['gallery', 'galleryHalf']:
-            frappe.throw(_("Invalid folder type. Must be 'gallery' or 'galleryHalf'"))
+        validate_target(service_id, folder_type)
         
         if not frappe.request.files:
             frappe.throw(_("No file uploaded"))
@@ -267,19 +339,12 @@ def upload_image(service_id, folder_type):
         if not uploaded_file:
             frappe.throw(_("No image file provided"))
         
-        if not uploaded_file.content_type.startswith('image/'):
-            frappe.throw(_("File must be an image"))
-        
         filename = secure_filename(uploaded_file.filename)
         if not filename:
             frappe.throw(_("Invalid filename"))
         
-        private_path = frappe.get_site_path("private", "files", "images")
-        folder_path = os.path.join(private_path, secure_service_id, secure_folder_type)
-        os.makedirs(folder_path, exist_ok=True)
-        
-        file_path = os.path.join(folder_path, filename)
-        uploaded_file.save(file_path)
+        temp_path, digest, size = stream_to_temp(uploaded_file.stream)
+        result = ingest_image(temp_path, digest, service_id, folder_type, filename)
         
         return {
             "success": True,
@@ -287,6 +352,9 @@ def upload_image(service_id, folder_type):
             "filename": filename,
             "service_id": service_id,
             "folder_type": folder_type,
+            "content_hash": digest,
+            "deduplicated": result["deduplicated"],
+            "duplicates": result["duplicates"],
             "url": f"/api/method/gallery_protection.api.gallery_api.serve_image?service_id={service_id}&folder_type={folder_type}&image_name={filename}"
         }
         
@@ -313,16 +381,14 @@ def delete_image(service_id, folder_type, image_name):
         if not secure_name or secure_name != image_name:
             frappe.throw(_("Invalid image name"))
         
-        private_path = frappe.get_site_path("private", "files", "images")
-        image_path = os.path.join(private_path, secure_service_id, secure_folder_type, image_name)
-        
-        real_image_path = os.path.realpath(image_path)
-        real_folder_path = os.path.realpath(os.path.join(private_path, secure_service_id, secure_folder_type))
-
-        if not os.path.exists(real_image_path) or not real_image_path.startswith(real_folder_path + os.sep):
+        storage = get_storage()
+        image_key = get_image_key(secure_service_id, secure_folder_type, secure_name)
+        if not storage.stat(image_key):
             frappe.throw("Image not found")
         
-        os.remove(real_image_path)
+        storage.delete(image_key)
+        remove_derived(storage, image_key)
+        forget_image_hash(secure_service_id, secure_folder_type, secure_name)
         
         return {
             "success": True,
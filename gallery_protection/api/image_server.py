@@ -0,0 +1,217 @@
+"""
+Standalone ASGI server for serve_image.
+
+Validates the session token and path, then returns image bytes without
+going through Frappe's request lifecycle (no DB connection, no handler
+dispatch). Cache reads are async; renders run on worker threads through
+the same coalescing render cache and bounded pool as serve_image.
+
+Run it as a bench process, e.g. in the Procfile:
+
+    image_server: cd sites && GALLERY_IMAGE_SERVER_SITE=example.com uvicorn gallery_protection.api.image_server:app --port 8010 --workers 2
+
+and let nginx route `/api/method/gallery_protection.api.gallery_api.serve_image` to it.
+"""
+import asyncio
+import contextvars
+import json
+import os
+import pickle
+from urllib.parse import parse_qs
+
+import frappe
+from redis import asyncio as aioredis
+
+from .gallery_api import (
+    resolve_image_path, get_watermark_render, load_image_content,
+    open_image_stream, get_image_mimetype, image_response_headers
+)
+from .cors_handler import get_cors_headers
+from .popularity import record_hit
+from .render_pool import RenderPoolSaturated
+from .session_manager import check_session_data, increment_session_usage, session_usage_key
+from .watermarker import ImageTooLarge
+
+SITE = os.environ.get("GALLERY_IMAGE_SERVER_SITE")
+SITES_PATH = os.environ.get("GALLERY_IMAGE_SERVER_SITES_PATH", ".")
+PATH = "/api/method/gallery_protection.api.gallery_api.serve_image"
+
+_redis = None
+_origin = contextvars.ContextVar("origin", default=None)
+
+
+def _get_redis():
+    global _redis
+    if _redis is None:
+        _redis = aioredis.from_url(frappe.conf.redis_cache)
+    return _redis
+
+
+async def _cache_get(key):
+    """
+    Async equivalent of frappe.cache().get_value for pickled values
+    """
+    value = await _get_redis().get(frappe.cache().make_key(key))
+    return pickle.loads(value) if value is not None else None
+
+
+async def _validate_session(session_token):
+    cache_key = f"session_token:{session_token}"
+    cache = frappe.cache()
+    session_value, image_requests = await _get_redis().mget(
+        cache.make_key(cache_key), cache.make_key(session_usage_key(session_token))
+    )
+    # Off the event loop: the expiry check looks up the system time zone
+    result = await asyncio.to_thread(
+        check_session_data, pickle.loads(session_value) if session_value is not None else None, int(image_requests or 0)
+    )
+    if result.get("expired"):
+        await _get_redis().delete(cache.make_key(cache_key))
+    return result
+
+
+async def _start(send, status, content_type, headers):
+    headers = {**get_cors_headers(_origin.get()), **headers}
+    raw_headers = [(b"content-type", content_type.encode())]
+    for name, value in headers.items():
+        raw_headers.append((name.lower().encode(), str(value).encode()))
+    await send({"type": "http.response.start", "status": status, "headers": raw_headers})
+
+
+async def _send(send, status, body, content_type, headers=None):
+    headers = {"Content-Length": len(body), **(headers or {})}
+    await _start(send, status, content_type, headers)
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _send_stream(send, status, chunks, content_type, headers):
+    """
+    Send a body from a blocking iterator of bytes chunks, one chunk in
+    memory at a time; each chunk is produced on a worker thread
+    """
+    try:
+        await _start(send, status, content_type, headers)
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                break
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        chunks.close()
+
+
+async def _send_json(send, status, message, headers=None):
+    # Same envelope Frappe wraps whitelisted method results in
+    await _send(send, status, json.dumps({"message": message}).encode(), "application/json", headers)
+
+
+async def _serve(scope, send):
+    headers = {name.decode().lower(): value.decode() for name, value in scope["headers"]}
+    params = {key: values[0] for key, values in parse_qs(scope["query_string"].decode()).items()}
+
+    session_token = headers.get("x-session-token")
+    if not session_token:
+        return await _send_json(send, 401, {
+            "success": False,
+            "error": "Session validation failed",
+            "message": "Missing session token in headers"
+        })
+
+    validation_result = await _validate_session(session_token)
+    if not validation_result.get("valid"):
+        return await _send_json(send, 403, {
+            "success": False,
+            "error": "Session validation failed",
+            "message": validation_result.get("message")
+        })
+
+    service_id = params.get("service_id")
+    folder_type = params.get("folder_type")
+    image_name = params.get("image_name")
+    if not all([service_id, folder_type, image_name]):
+        return await _send_json(send, 400, {"error": "Missing required parameters"})
+
+    try:
+        # Storage lookups may be network round trips (S3), so keep them off the event loop
+        image_key, secure_name, image_stat = await asyncio.to_thread(
+            resolve_image_path, service_id, folder_type, image_name
+        )
+
+        if folder_type != "gallery":
+            # Raw delivery is streamed from storage, with Range support
+            status, stream_headers, mimetype, chunks = await asyncio.to_thread(
+                open_image_stream, image_key, image_stat, secure_name, headers.get("range")
+            )
+            await asyncio.to_thread(increment_session_usage, session_token)
+            await asyncio.to_thread(record_hit, service_id, folder_type, secure_name)
+            return await _send_stream(send, status, chunks, mimetype, stream_headers)
+
+        key, _profile, _limits = await asyncio.to_thread(get_watermark_render, service_id, image_key, image_stat)
+        file_content = await _cache_get(key)
+
+        if file_content is None:
+            # Cache miss: rendering happens off the event loop
+            file_content, mimetype = await asyncio.to_thread(
+                load_image_content, service_id, folder_type, image_key, image_stat
+            )
+        else:
+            mimetype = get_image_mimetype(file_content)
+
+        await asyncio.to_thread(increment_session_usage, session_token)
+        await asyncio.to_thread(record_hit, service_id, folder_type, secure_name)
+        await _send(send, 200, file_content, mimetype, image_response_headers(secure_name, len(file_content)))
+
+    except RenderPoolSaturated as e:
+        await _send(send, 503, str(e).encode(), "text/plain", {
+            "Retry-After": e.retry_after,
+            "Cache-Control": "no-store"
+        })
+    except ImageTooLarge as e:
+        await _send_json(send, 422, {"error": "Image too large to render", "description": str(e)})
+    except frappe.DoesNotExistError:
+        await _send_json(send, 404, {"error": "Image not found"})
+    except frappe.ValidationError as e:
+        await _send_json(send, 400, {"error": str(e)})
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                if not SITE:
+                    await send({"type": "lifespan.startup.failed", "message": "GALLERY_IMAGE_SERVER_SITE is not set"})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if _redis is not None:
+                    await _redis.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    if scope["type"] != "http":
+        return
+
+    # Site context only: config, cache and paths, no database connection.
+    # frappe.init reads the site config from disk, so it runs on a worker
+    # thread; frappe.local lives in context variables, so it runs in a
+    # context of its own that the request is then handled in.
+    context = contextvars.copy_context()
+    await asyncio.to_thread(context.run, frappe.init, site=SITE, sites_path=SITES_PATH)
+    await context.run(asyncio.ensure_future, _handle(scope, send))
+
+
+async def _handle(scope, send):
+    try:
+        _origin.set(next((value.decode() for name, value in scope["headers"] if name == b"origin"), None))
+        if scope["path"] != PATH or scope["method"] not in ("GET", "OPTIONS"):
+            return await _send_json(send, 404, {"error": "Not found"})
+        if scope["method"] == "OPTIONS":
+            return await _send(send, 204, b"", "text/plain")
+        await _serve(scope, send)
+    except Exception as e:
+        frappe.logger().error(f"Error in image_server: {str(e)}")
+        await _send_json(send, 500, {"error": "Internal server error"})
+    finally:
+        frappe.destroy()
@@ -0,0 +1,184 @@
+import frappe
+import hashlib
+import os
+import shutil
+import time
+import uuid
+from frappe import _
+from werkzeug.utils import secure_filename
+
+FOLDER_TYPES = ['gallery', 'galleryHalf']
+COPY_BUFFER_SIZE = 1024 * 1024
+DEFAULT_MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+DEFAULT_UPLOAD_TTL = 86400
+DEFAULT_STORAGE_CACHE_TTL = 7 * 86400
+BLOB_GRACE_PERIOD = 3600
+
+
+def get_images_root():
+    return frappe.get_site_path("private", "files", "images")
+
+
+def get_blobs_root():
+    return frappe.get_site_path("private", "files", "gallery_blobs")
+
+
+def get_uploads_root():
+    return frappe.get_site_path("private", "files", "gallery_uploads")
+
+
+def get_storage_cache_root():
+    return frappe.get_site_path("private", "files", "gallery_storage_cache")
+
+
+def get_max_upload_bytes():
+    return int(frappe.conf.get("gallery_upload_max_bytes") or DEFAULT_MAX_UPLOAD_BYTES)
+
+
+def validate_target(service_id, folder_type):
+    """
+    Check service ID and folder type of an upload target
+    """
+    secure_service_id = secure_filename(service_id or "")
+    secure_folder_type = secure_filename(folder_type or "")
+
+    if not secure_service_id or secure_service_id != service_id:
+        frappe.throw(_("Invalid service ID"))
+
+    if secure_folder_type not in FOLDER_TYPES:
+        frappe.throw(_("Invalid folder type. Must be 'gallery' or 'galleryHalf'"))
+
+
+def new_temp_path():
+    uploads_root = get_uploads_root()
+    os.makedirs(uploads_root, exist_ok=True)
+    return os.path.join(uploads_root, f"{uuid.uuid4().hex}.part")
+
+
+def stream_to_temp(stream, max_bytes=None):
+    """
+    Copy a file-like stream to a temp file while hashing it.
+    Returns (temp_path, sha256 hex digest, size).
+    """
+    max_bytes = max_bytes or get_max_upload_bytes()
+    temp_path = new_temp_path()
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        with open(temp_path, 'wb') as f:
+            while True:
+                chunk = stream.read(COPY_BUFFER_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    frappe.throw(_("File exceeds the maximum upload size of {0} bytes").format(max_bytes))
+                hasher.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        _remove_quietly(temp_path)
+        raise
+    return temp_path, hasher.hexdigest(), size
+
+
+def hash_file(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(COPY_BUFFER_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def store_file(temp_path, digest, folder_path, filename):
+    """
+    Move a fully written temp file into place under `folder_path/filename`.
+
+    Content is kept once per SHA-256 in the blob store and linked into the
+    gallery folder, so re-uploads of the same bytes cost no extra space. The
+    final rename is atomic: readers never see a partially written image.
+    Returns True if the content was already stored.
+    """
+    blob_path = os.path.join(get_blobs_root(), digest[:2], digest)
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    os.makedirs(folder_path, exist_ok=True)
+
+    staging_path = os.path.join(folder_path, f".{filename}.{uuid.uuid4().hex}.tmp")
+    try:
+        deduplicated = _link_blob(temp_path, blob_path, staging_path)
+        os.replace(staging_path, os.path.join(folder_path, filename))
+    except BaseException:
+        _remove_quietly(staging_path)
+        raise
+
+    if deduplicated:
+        _remove_quietly(temp_path)
+    return deduplicated
+
+
+def _link_blob(temp_path, blob_path, staging_path):
+    """
+    Link the blob for `temp_path`'s content to `staging_path`, moving the
+    temp file into the blob store first if the content is new. The temp
+    file is kept until the link exists, so a blob pruned in between is
+    simply stored again. Returns True if the blob was already there.
+    """
+    while True:
+        deduplicated = os.path.exists(blob_path)
+        if not deduplicated:
+            os.replace(temp_path, blob_path)
+        try:
+            os.link(blob_path, staging_path)
+        except FileNotFoundError:
+            if not deduplicated:
+                raise
+            # Pruned since the check above: store the content again
+            continue
+        except OSError:
+            # Filesystem without hardlink support: fall back to a private copy
+            shutil.copyfile(blob_path, staging_path)
+        return deduplicated
+
+
+def prune_store():
+    """
+    Scheduled job: drop blobs no gallery file links to any more, temp files
+    of uploads that were abandoned and local copies of remote images that
+    have not been read for a while
+    """
+    blobs_root = get_blobs_root()
+    if os.path.isdir(blobs_root):
+        # A blob linked or stored just now may not have its gallery link yet
+        blob_cutoff = time.time() - BLOB_GRACE_PERIOD
+        for shard in os.listdir(blobs_root):
+            shard_path = os.path.join(blobs_root, shard)
+            if not os.path.isdir(shard_path):
+                continue
+            for name in os.listdir(shard_path):
+                blob_path = os.path.join(shard_path, name)
+                blob_stat = os.stat(blob_path)
+                if blob_stat.st_nlink <= 1 and blob_stat.st_ctime < blob_cutoff:
+                    _remove_quietly(blob_path)
+
+    uploads_root = get_uploads_root()
+    if os.path.isdir(uploads_root):
+        cutoff = time.time() - int(frappe.conf.get("gallery_upload_ttl") or DEFAULT_UPLOAD_TTL)
+        for name in os.listdir(uploads_root):
+            temp_path = os.path.join(uploads_root, name)
+            if os.path.isfile(temp_path) and os.stat(temp_path).st_mtime < cutoff:
+                _remove_quietly(temp_path)
+
+    cache_root = get_storage_cache_root()
+    if os.path.isdir(cache_root):
+        cutoff = time.time() - int(frappe.conf.get("gallery_storage_cache_ttl") or DEFAULT_STORAGE_CACHE_TTL)
+        for dirpath, dirnames, filenames in os.walk(cache_root):
+            for name in filenames:
+                cached_path = os.path.join(dirpath, name)
+                if os.stat(cached_path).st_mtime < cutoff:
+                    _remove_quietly(cached_path)
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
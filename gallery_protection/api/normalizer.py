@@ -0,0 +1,348 @@
+import frappe
+import posixpath
+from frappe import _
+from PIL import Image, ImageOps
+from .image_store import FOLDER_TYPES, new_temp_path, _remove_quietly
+from .placeholders import META_EXT, describe_image, get_meta_key, encode_meta, decode_meta
+from .storage import get_storage, get_image_key
+from .duplicates import check_duplicates, record_image_hash
+
+DEFAULT_MAX_IMAGE_PIXELS = 80_000_000
+DEFAULT_MASTER_MAX_EDGE = 2560
+DEFAULT_MASTER_QUALITY = 85
+MASTERS_DIR = ".masters"
+MASTER_EXT = ".webp"
+# Sidecar field: storage version of the image the master was built from
+SOURCE_VERSION = "source_version"
+
+# (offset, magic bytes, format) checked against the first bytes of a file
+SIGNATURES = [
+    (0, b"\xff\xd8\xff", "JPEG"),
+    (0, b"\x89PNG\r\n\x1a\n", "PNG"),
+    (0, b"GIF87a", "GIF"),
+    (0, b"GIF89a", "GIF"),
+    (8, b"WEBP", "WEBP"),
+    (0, b"BM", "BMP"),
+    (0, b"II*\x00", "TIFF"),
+    (0, b"MM\x00*", "TIFF"),
+]
+HEADER_SIZE = 16
+
+
+def sniff_format(header):
+    """
+    Return the image format named by a file's leading bytes, or None
+    """
+    for offset, magic, image_format in SIGNATURES:
+        if header[offset:offset + len(magic)] == magic:
+            if image_format == "WEBP" and header[:4] != b"RIFF":
+                continue
+            return image_format
+    return None
+
+
+def sniff_file(path):
+    with open(path, 'rb') as f:
+        return sniff_format(f.read(HEADER_SIZE))
+
+
+def get_max_image_pixels():
+    return int(frappe.conf.get("gallery_max_image_pixels") or DEFAULT_MAX_IMAGE_PIXELS)
+
+
+def get_master_key(image_key):
+    return posixpath.join(posixpath.dirname(image_key), MASTERS_DIR, posixpath.basename(image_key) + MASTER_EXT)
+
+
+def _read_sidecar(storage, master_key):
+    """
+    A master's layout metadata and the version of the image it was built
+    from, as (meta, source_version); (None, None) without a sidecar
+    """
+    try:
+        meta = decode_meta(storage.read(get_meta_key(master_key)))
+    except FileNotFoundError:
+        meta = None
+    if not meta:
+        return None, None
+    return meta, meta.pop(SOURCE_VERSION, None)
+
+
+def _write_sidecar(storage, master_key, meta, source_version):
+    storage.put_bytes(get_meta_key(master_key), encode_meta({**meta, SOURCE_VERSION: source_version}))
+
+
+def _is_current(source_version, master_stat, image_stat):
+    """
+    Whether a master was built from the image as it is now
+    """
+    if source_version:
+        return source_version == image_stat["version"]
+    # Sidecars written before the source version was recorded. Modification
+    # times can be wrong: a replaced image linked to an older blob takes that
+    # blob's mtime, which a stale master may be newer than.
+    return bool(master_stat) and master_stat["modified"] >= image_stat["modified"]
+
+
+def get_render_source(storage, image_key, image_stat=None):
+    """
+    Key to render or deliver an image from: its normalized master when that
+    was built from the current image, otherwise the original
+    """
+    image_stat = image_stat or storage.stat(image_key)
+    if image_stat:
+        master_key = get_master_key(image_key)
+        _meta, source_version = _read_sidecar(storage, master_key)
+        master_stat = None if source_version else storage.stat(master_key)
+        if _is_current(source_version, master_stat, image_stat):
+            return master_key
+    return image_key
+
+
+def inspect_image(path):
+    """
+    Check that a file really is a supported image of acceptable dimensions,
+    without decoding its pixels. Returns the image format.
+    """
+    header_format = sniff_file(path)
+    if not header_format:
+        frappe.throw(_("File is not a supported image"))
+
+    max_pixels = get_max_image_pixels()
+    try:
+        with Image.open(path) as image:
+            image_format = image.format
+            width, height = image.size
+    except Image.DecompressionBombError:
+        frappe.throw(_("Image dimensions exceed the allowed limit"))
+    except Exception:
+        frappe.throw(_("File is not a valid image"))
+
+    if image_format != header_format:
+        frappe.throw(_("Image content does not match its format"))
+
+    if width * height > max_pixels:
+        frappe.throw(_("Image is {0}x{1} pixels, the limit is {2} pixels").format(width, height, max_pixels))
+
+    return image_format
+
+
+def build_master(source_path, target_path):
+    """
+    Decode an image once and write the normalized master: EXIF orientation
+    applied, metadata stripped, longest edge capped and re-encoded as WebP.
+    Returns the master's layout metadata (see placeholders.describe_image).
+    """
+    max_edge = int(frappe.conf.get("gallery_master_max_edge") or DEFAULT_MASTER_MAX_EDGE)
+    quality = int(frappe.conf.get("gallery_master_quality") or DEFAULT_MASTER_QUALITY)
+    resample_filter = getattr(Image, 'Resampling', Image).LANCZOS
+
+    with Image.open(source_path) as image:
+        # Let the JPEG decoder skip detail we are about to throw away
+        image.draft("RGB", (max_edge, max_edge))
+        oriented = ImageOps.exif_transpose(image)
+        has_alpha = oriented.mode in ("RGBA", "LA") or (oriented.mode == "P" and "transparency" in oriented.info)
+        master = oriented.convert("RGBA" if has_alpha else "RGB")
+        master.thumbnail((max_edge, max_edge), resample_filter)
+
+    # Saved without exif/icc/xmp, which drops the camera metadata
+    master.save(target_path, format="WEBP", quality=quality, method=4)
+    return describe_image(master)
+
+
+def ingest_image(temp_path, digest, service_id, folder_type, filename):
+    """
+    Validate an uploaded temp file, store it and write its normalized master.
+    The temp file is consumed either way. Returns a dict describing the result.
+    """
+    storage = get_storage()
+    image_key = get_image_key(service_id, folder_type, filename)
+    master_temp_path = f"{temp_path}.master{MASTER_EXT}"
+    try:
+        image_format = inspect_image(temp_path)
+        try:
+            meta = build_master(temp_path, master_temp_path)
+        except Exception:
+            frappe.throw(_("File is not a valid image"))
+        duplicates = check_duplicates(service_id, folder_type, filename, meta.get("dhash"))
+
+        # Sidecar last: it names the version of the original the master was
+        # built from, and until it is written the old one no longer matches
+        deduplicated = storage.put_file(temp_path, image_key, digest)
+        master_key = get_master_key(image_key)
+        storage.put_file(master_temp_path, master_key)
+        _write_sidecar(storage, master_key, meta, storage.stat(image_key)["version"])
+        record_image_hash(service_id, folder_type, filename, meta.get("dhash"))
+
+        return {
+            "format": image_format,
+            "deduplicated": deduplicated,
+            "duplicates": duplicates,
+            "meta": meta,
+            "key": image_key
+        }
+    finally:
+        _remove_quietly(temp_path)
+        _remove_quietly(master_temp_path)
+
+
+def get_image_meta(storage, image_key, image_stat=None):
+    """
+    Layout metadata for an image, computed from its master the first time it
+    is asked for. Returns None for images that have no current master.
+    Sidecars written before perceptual hashing are returned as they are;
+    their hashes are filled in by `backfill_masters` or the duplicate index
+    seeding job, never while a request waits.
+    """
+    image_stat = image_stat or storage.stat(image_key)
+    if not image_stat:
+        return None
+
+    master_key = get_master_key(image_key)
+    meta, source_version = _read_sidecar(storage, master_key)
+    master_stat = None if source_version else storage.stat(master_key)
+    if not _is_current(source_version, master_stat, image_stat):
+        return None
+    return meta or refresh_image_meta(storage, image_key, image_stat)
+
+
+def refresh_image_meta(storage, image_key, image_stat=None):
+    """
+    Describe an image's master again and rewrite its metadata sidecar, which
+    from then on names the image's current version as the master's source;
+    only call it for masters that are current. Returns None if the master
+    cannot be read.
+    """
+    master_key = get_master_key(image_key)
+    try:
+        image_stat = image_stat or storage.stat(image_key)
+        with Image.open(storage.local_path(master_key)) as master:
+            meta = describe_image(master)
+        _write_sidecar(storage, master_key, meta, image_stat["version"])
+        return meta
+    except Exception as e:
+        frappe.logger().warning(f"Could not describe {image_key}: {str(e)}")
+        return None
+
+
+def _meta_cache_key(service_id, folder_type):
+    return f"gallery_image_meta:{service_id}:{folder_type}"
+
+
+def get_folder_meta(storage, service_id, folder_type, images):
+    """
+    Layout metadata of a folder's images for listings, as {filename: meta}.
+    Masters and sidecars are found with one listing of the folder's derived
+    files, and sidecar contents are served from a Redis copy while the
+    sidecar is unchanged, so a listing does not cost requests per image.
+    Images without a current master are left out.
+    """
+    derived = storage.list_derived(service_id, folder_type, MASTERS_DIR)
+    cache = frappe.cache()
+    cache_key = _meta_cache_key(service_id, folder_type)
+    cached = {
+        (name.decode() if isinstance(name, bytes) else name): entry
+        for name, entry in (cache.hgetall(cache_key) or {}).items()
+    }
+
+    metas = {}
+    for filename, image_stat in images:
+        master_stat = derived.get(filename + MASTER_EXT)
+        if not master_stat:
+            continue
+        meta_stat = derived.get(filename + MASTER_EXT + META_EXT)
+        entry = cached.get(filename)
+        if meta_stat and entry and entry["version"] == meta_stat["version"]:
+            if _is_current(entry.get(SOURCE_VERSION), master_stat, image_stat):
+                metas[filename] = entry["meta"]
+            continue
+
+        image_key = get_image_key(service_id, folder_type, filename)
+        master_key = get_master_key(image_key)
+        meta, source_version = _read_sidecar(storage, master_key)
+        if not _is_current(source_version, master_stat, image_stat):
+            continue
+        if not meta:
+            meta = refresh_image_meta(storage, image_key, image_stat)
+            source_version = image_stat["version"]
+        if meta:
+            metas[filename] = meta
+            meta_stat = storage.stat(get_meta_key(master_key))
+            if meta_stat:
+                cache.hset(cache_key, filename, {"version": meta_stat["version"], SOURCE_VERSION: source_version, "meta": meta})
+
+    # Entries of images that are gone
+    names = {filename for filename, image_stat in images}
+    for name in cached:
+        if name not in names:
+            cache.hdel(cache_key, name)
+    return metas
+
+
+def copy_sidecar(source, target, image_key):
+    """
+    Copy the sidecar of an image's current master to another backend, naming
+    the image's version there as the source: storage versions differ between
+    backends. Returns False if there is nothing to copy or the target's
+    sidecar already names it.
+    """
+    master_key = get_master_key(image_key)
+    target_stat = target.stat(image_key)
+    _meta, target_version = _read_sidecar(target, master_key)
+    if not target_stat or target_version == target_stat["version"]:
+        return False
+    meta, _source_version = _read_sidecar(source, master_key)
+    if not meta:
+        return False
+    _write_sidecar(target, master_key, meta, target_stat["version"])
+    return True
+
+
+def remove_derived(storage, image_key):
+    """
+    Remove files derived from an image when the image itself is deleted
+    """
+    master_key = get_master_key(image_key)
+    # Sidecar first: a sidecar naming the current image means its master exists
+    storage.delete(get_meta_key(master_key))
+    storage.delete(master_key)
+
+
+def backfill_masters(service_id=None):
+    """
+    Write masters and layout metadata for images stored before normalization
+    existed, and perceptual hashes for metadata written before hashing.
+    Run with `bench execute gallery_protection.api.normalizer.backfill_masters`.
+    """
+    storage = get_storage()
+    written = 0
+    services = [service_id] if service_id else storage.list_services()
+    for service in services:
+        for folder_type in FOLDER_TYPES:
+            images = list(storage.list_images(service, folder_type))
+            metas = get_folder_meta(storage, service, folder_type, images)
+            for filename, image_stat in images:
+                image_key = get_image_key(service, folder_type, filename)
+                if filename in metas:
+                    if not metas[filename].get("dhash"):
+                        meta = refresh_image_meta(storage, image_key, image_stat)
+                        if meta:
+                            record_image_hash(service, folder_type, filename, meta.get("dhash"))
+                            written += 1
+                    continue
+                if get_render_source(storage, image_key, image_stat) != image_key:
+                    continue
+                master_temp_path = f"{new_temp_path()}{MASTER_EXT}"
+                try:
+                    image_path = storage.local_path(image_key)
+                    inspect_image(image_path)
+                    meta = build_master(image_path, master_temp_path)
+                    master_key = get_master_key(image_key)
+                    storage.put_file(master_temp_path, master_key)
+                    _write_sidecar(storage, master_key, meta, image_stat["version"])
+                    record_image_hash(service, folder_type, filename, meta.get("dhash"))
+                    written += 1
+                except Exception as e:
+                    _remove_quietly(master_temp_path)
+                    frappe.logger().warning(f"Could not normalize {image_key}: {str(e)}")
+    return written
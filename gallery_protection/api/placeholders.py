@@ -0,0 +1,65 @@
+import base64
+import io
+import json
+from PIL import Image
+
+LQIP_EDGE = 16
+LQIP_QUALITY = 40
+DHASH_SIZE = 8
+META_EXT = ".json"
+
+
+def describe_image(image):
+    """
+    Layout metadata for a decoded image: dimensions, dominant colour, a tiny
+    base64 WebP preview (LQIP) clients can blur while the real image loads,
+    and a perceptual hash used to spot near-duplicates
+    """
+    resample_filter = getattr(Image, 'Resampling', Image)
+    rgb = image.convert("RGB")
+
+    average = rgb.resize((1, 1), resample_filter.BOX).getpixel((0, 0))
+
+    preview = rgb.copy()
+    preview.thumbnail((LQIP_EDGE, LQIP_EDGE), resample_filter.BILINEAR)
+    buffer = io.BytesIO()
+    preview.save(buffer, format="WEBP", quality=LQIP_QUALITY)
+
+    return {
+        "width": image.width,
+        "height": image.height,
+        "dominant_color": "#{:02x}{:02x}{:02x}".format(*average[:3]),
+        "lqip": "data:image/webp;base64," + base64.b64encode(buffer.getvalue()).decode(),
+        "dhash": compute_dhash(rgb)
+    }
+
+
+def compute_dhash(image):
+    """
+    64-bit difference hash as 16 hex digits: one bit per pixel of a 9x8
+    grayscale thumbnail, set when it is brighter than its right neighbour.
+    Survives rescaling, recompression and small edits.
+    """
+    resample_filter = getattr(Image, 'Resampling', Image).BOX
+    pixels = image.convert("L").resize((DHASH_SIZE + 1, DHASH_SIZE), resample_filter).tobytes()
+    value = 0
+    for row in range(DHASH_SIZE):
+        for col in range(DHASH_SIZE):
+            offset = row * (DHASH_SIZE + 1) + col
+            value = (value << 1) | (pixels[offset] > pixels[offset + 1])
+    return f"{value:016x}"
+
+
+def get_meta_key(master_key):
+    return master_key + META_EXT
+
+
+def encode_meta(meta):
+    return json.dumps(meta).encode()
+
+
+def decode_meta(data):
+    try:
+        return json.loads(data)
+    except ValueError:
+        return None
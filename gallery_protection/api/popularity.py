@@ -0,0 +1,212 @@
+import frappe
+import atexit
+import threading
+import time
+from collections import Counter
+from frappe.utils import now_datetime, get_datetime
+from redis import Redis
+from .render_cache import get_or_render, DEFAULT_CACHE_TTL
+from .storage import get_storage
+
+DOCTYPE = "Gallery Image Popularity"
+KEYS_SET = "gallery_popularity_keys"
+BUFFER_MAX_HITS = 50
+BUFFER_MAX_AGE = 5
+DEFAULT_HALF_LIFE_HOURS = 24
+DEFAULT_WARM_TOP_N = 20
+DEFAULT_WARM_CPU_SECONDS = 60
+
+_buffer = Counter()
+_buffer_cache = None
+_flush_timer = None
+_buffer_lock = threading.Lock()
+
+
+def _counter_key(service_id, folder_type):
+    return f"gallery_popularity:{service_id}:{folder_type}"
+
+
+def record_hit(service_id, folder_type, image_name):
+    """
+    Count an image view. Hits are buffered per worker and sent to Redis in
+    one pipeline after BUFFER_MAX_AGE seconds or every BUFFER_MAX_HITS views;
+    a timer sends them even if no further request arrives.
+    """
+    global _buffer_cache, _flush_timer
+    # Keys are made here: the timer thread has no site context
+    cache = frappe.cache()
+    entry = (cache.make_key(KEYS_SET), cache.make_key(_counter_key(service_id, folder_type)), f"{service_id}:{folder_type}", image_name)
+    with _buffer_lock:
+        _buffer[entry] += 1
+        _buffer_cache = cache
+        full = sum(_buffer.values()) >= BUFFER_MAX_HITS
+        if not full and _flush_timer is None:
+            _flush_timer = threading.Timer(BUFFER_MAX_AGE, flush_hit_buffer)
+            _flush_timer.daemon = True
+            _flush_timer.start()
+
+    if full:
+        flush_hit_buffer()
+
+
+def flush_hit_buffer():
+    """
+    Send this worker's buffered hits to Redis. Also runs when the worker exits.
+    """
+    global _buffer, _flush_timer
+    with _buffer_lock:
+        pending, _buffer = _buffer, Counter()
+        cache = _buffer_cache
+        if _flush_timer is not None:
+            _flush_timer.cancel()
+            _flush_timer = None
+
+    if pending:
+        try:
+            _push_hits(cache, pending)
+        except Exception as e:
+            frappe.logger().warning(f"Could not record image popularity: {str(e)}")
+
+
+atexit.register(flush_hit_buffer)
+
+
+def _push_hits(cache, hits):
+    pipe = cache.pipeline(transaction=False)
+    for (keys_set, counter_key, member, image_name), count in hits.items():
+        pipe.zincrby(counter_key, count, image_name)
+        pipe.sadd(keys_set, member)
+    pipe.execute()
+
+
+def _decay(elapsed_seconds):
+    half_life = float(frappe.conf.get("gallery_popularity_half_life_hours") or DEFAULT_HALF_LIFE_HOURS) * 3600
+    return 0.5 ** (max(elapsed_seconds, 0) / half_life)
+
+
+def flush_popularity():
+    """
+    Scheduled job: move hit counters from Redis into Gallery Image Popularity
+    """
+    # This worker's own hits; web workers send theirs on a timer
+    flush_hit_buffer()
+
+    cache = frappe.cache()
+    keys_set = cache.make_key(KEYS_SET)
+    now = now_datetime()
+
+    # Made keys throughout, as the hits are sent through a plain pipeline;
+    # the wrapper's smembers would prefix the set name a second time
+    for member in Redis.smembers(cache, keys_set):
+        member = member.decode() if isinstance(member, bytes) else member
+        service_id, folder_type = member.split(":", 1)
+        counter_key = cache.make_key(_counter_key(service_id, folder_type))
+
+        # Read and reset atomically; hits arriving afterwards start a new counter
+        pipe = cache.pipeline(transaction=True)
+        pipe.zrange(counter_key, 0, -1, withscores=True)
+        pipe.delete(counter_key)
+        pipe.srem(keys_set, member)
+        entries = pipe.execute()[0]
+
+        try:
+            for image_name, count in entries:
+                image_name = image_name.decode() if isinstance(image_name, bytes) else image_name
+                _add_hits(service_id, folder_type, image_name, int(count), now)
+            frappe.db.commit()
+        except Exception as e:
+            # Put the hits back so the next run counts them
+            frappe.db.rollback()
+            _push_hits(cache, {(keys_set, counter_key, member, image_name): count for image_name, count in entries})
+            frappe.log_error(f"Error flushing popularity for {member}: {str(e)}")
+
+
+def _add_hits(service_id, folder_type, image_name, count, now):
+    image_key = f"{service_id}/{folder_type}/{image_name}"
+    existing = frappe.db.get_value(DOCTYPE, {"image_key": image_key}, ["name", "hits", "score", "last_accessed"], as_dict=True)
+
+    if existing:
+        elapsed = (now - get_datetime(existing.last_accessed)).total_seconds() if existing.last_accessed else 0
+        frappe.db.set_value(DOCTYPE, existing.name, {
+            "hits": (existing.hits or 0) + count,
+            "score": (existing.score or 0) * _decay(elapsed) + count,
+            "last_accessed": now
+        }, update_modified=False)
+    else:
+        frappe.get_doc({
+            "doctype": DOCTYPE,
+            "image_key": image_key,
+            "service_id": service_id,
+            "folder_type": folder_type,
+            "image_name": image_name,
+            "hits": count,
+            "score": count,
+            "last_accessed": now
+        }).insert(ignore_permissions=True)
+
+
+def get_popular_images(service_id, folder_type="gallery", limit=DEFAULT_WARM_TOP_N):
+    """
+    Most popular image names of a service, by score decayed to now
+    """
+    now = now_datetime()
+    rows = frappe.get_all(
+        DOCTYPE,
+        filters={"service_id": service_id, "folder_type": folder_type},
+        fields=["image_name", "score", "last_accessed"],
+        order_by="score desc",
+        limit_page_length=limit * 3
+    )
+    for row in rows:
+        elapsed = (now - get_datetime(row.last_accessed)).total_seconds() if row.last_accessed else 0
+        row.current_score = (row.score or 0) * _decay(elapsed)
+    rows.sort(key=lambda row: row.current_score, reverse=True)
+    return [row.image_name for row in rows[:limit]]
+
+
+def warm_popular_renders():
+    """
+    Scheduled job: pre-render (or extend the cache lifetime of) the watermarked
+    renders of each service's most popular images, within a CPU time budget
+    """
+    # Imported here as gallery_api records hits through this module
+    from .gallery_api import resolve_image_path, get_watermark_render, render_stored_image
+
+    top_n = int(frappe.conf.get("gallery_warm_top_n") or DEFAULT_WARM_TOP_N)
+    budget = float(frappe.conf.get("gallery_warm_cpu_seconds") or DEFAULT_WARM_CPU_SECONDS)
+    cache_ttl = int(frappe.conf.get("gallery_render_cache_ttl") or DEFAULT_CACHE_TTL)
+    started = time.process_time()
+    rendered = refreshed = 0
+
+    services = frappe.get_all(DOCTYPE, filters={"folder_type": "gallery"}, pluck="service_id", distinct=True)
+    for service_id in services:
+        for image_name in get_popular_images(service_id, "gallery", top_n):
+            if time.process_time() - started > budget:
+                frappe.logger().info(f"Render warming stopped at CPU budget: {rendered} rendered, {refreshed} refreshed")
+                return
+            try:
+                image_key, _secure_name, image_stat = resolve_image_path(service_id, "gallery", image_name)
+                key, profile, limits = get_watermark_render(service_id, image_key, image_stat)
+                # EXPIRE answers whether the render is cached and extends it in one call
+                if frappe.cache().expire(frappe.cache().make_key(key), cache_ttl):
+                    refreshed += 1
+                else:
+                    get_or_render(key, render_stored_image, get_storage(), image_key, image_stat, profile, limits)
+                    rendered += 1
+            except Exception as e:
+                frappe.logger().warning(f"Could not warm {service_id}/{image_name}: {str(e)}")
+
+    frappe.logger().info(f"Render warming done: {rendered} rendered, {refreshed} refreshed")
+
+
+def enqueue_warm_popular_renders():
+    """
+    after_migrate hook: refill the render cache after a deploy without
+    blocking the migration
+    """
+    frappe.enqueue(
+        method="gallery_protection.api.popularity.warm_popular_renders",
+        queue="long",
+        job_name="Warm popular gallery renders",
+        now=False
+    )
@@ -0,0 +1,128 @@
+import frappe
+import hashlib
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from redis.exceptions import LockError
+from .render_pool import render
+
+DEFAULT_CACHE_TTL = 86400
+DEFAULT_CACHE_MAX_BYTES = 5 * 1024 * 1024
+DEFAULT_LOCK_TTL = 30
+DEFAULT_COALESCE_WAIT = 10
+POLL_INTERVAL = 0.05
+
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def make_render_key(image_key, variant, version):
+    """
+    Cache key for a rendered variant of an image; `version` comes from the
+    storage backend's stat and changes whenever the image does
+    """
+    key_hash = hashlib.sha1(image_key.encode()).hexdigest()
+    return f"gallery_render:{variant}:{key_hash}:{version}"
+
+
+def get_cached_render(key):
+    # expires=True skips the per-request memo so polling sees other workers' writes
+    return frappe.cache().get_value(key, expires=True)
+
+
+def _uncacheable_key(key):
+    return f"gallery_render_uncacheable:{key}"
+
+
+def set_cached_render(key, content):
+    """
+    Cache a render. One over `gallery_render_cache_max_bytes` is not stored;
+    instead the key is marked so other callers render it themselves rather
+    than wait for a result that will never land in the cache.
+    """
+    ttl = int(frappe.conf.get("gallery_render_cache_ttl") or DEFAULT_CACHE_TTL)
+    if len(content) > int(frappe.conf.get("gallery_render_cache_max_bytes") or DEFAULT_CACHE_MAX_BYTES):
+        frappe.cache().set_value(_uncacheable_key(key), 1, expires_in_sec=ttl)
+        return False
+    frappe.cache().set_value(key, content, expires_in_sec=ttl)
+    return True
+
+
+def is_uncacheable(key):
+    return bool(frappe.cache().get_value(_uncacheable_key(key), expires=True))
+
+
+def get_or_render(key, fn, *args, **kwargs):
+    """
+    Return the cached render for `key`, rendering it at most once.
+
+    Concurrent callers in this process wait on the first caller's future;
+    callers in other workers or hosts wait on a short Redis lock and then read
+    the cached result. Anyone who waits too long renders inline instead.
+    """
+    content = get_cached_render(key)
+    if content is not None:
+        return content
+
+    with _inflight_lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = Future()
+            _inflight[key] = future
+
+    if not leader:
+        try:
+            return future.result(timeout=_coalesce_wait())
+        except FutureTimeoutError:
+            return render(fn, *args, **kwargs)
+
+    try:
+        content = _render_once_across_workers(key, fn, args, kwargs)
+        future.set_result(content)
+        return content
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+
+
+def _render_once_across_workers(key, fn, args, kwargs):
+    cache = frappe.cache()
+    lock_ttl = int(frappe.conf.get("gallery_render_lock_ttl") or DEFAULT_LOCK_TTL)
+    lock = cache.lock(cache.make_key(f"gallery_render_lock:{key}"), timeout=lock_ttl)
+    deadline = time.monotonic() + _coalesce_wait()
+
+    while True:
+        if is_uncacheable(key):
+            # Nothing to wait for: its result is never cached
+            return render(fn, *args, **kwargs)
+
+        if lock.acquire(blocking=False):
+            try:
+                content = render(fn, *args, **kwargs)
+                set_cached_render(key, content)
+                return content
+            finally:
+                try:
+                    lock.release()
+                except LockError:
+                    # Expired while rendering; it may belong to someone else now
+                    pass
+
+        # Another worker holds the lock: wait for its result to land in the cache
+        while time.monotonic() < deadline:
+            time.sleep(POLL_INTERVAL)
+            content = get_cached_render(key)
+            if content is not None:
+                return content
+            if not lock.locked():
+                break
+        else:
+            return render(fn, *args, **kwargs)
+
+
+def _coalesce_wait():
+    return float(frappe.conf.get("gallery_render_coalesce_wait") or DEFAULT_COALESCE_WAIT)
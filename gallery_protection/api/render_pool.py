@@ -0,0 +1,291 @@
+import frappe
+import os
+import resource
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+DEFAULT_WORKERS = 2
+DEFAULT_QUEUE_DEPTH = 8
+DEFAULT_TIMEOUT = 30
+DEFAULT_RETRY_AFTER = 5
+METRICS_KEY = "gallery_render_metrics"
+METRICS_PUBLISH_INTERVAL = 5
+METRICS_STALE_AFTER = 300
+DEFAULT_SLOT_TTL = 300
+SLOT_POLL_INTERVAL = 0.05
+ADMITTED_KEY = "gallery_render_admitted"
+RUNNING_KEY = "gallery_render_running"
+
+# Counting semaphore shared by every worker: a sorted set of slot tokens
+# scored by expiry. Expired tokens (from a worker that died holding them) are
+# dropped first; returns 1 when the token got a slot, 0 when all are taken.
+ACQUIRE_SLOT_SCRIPT = """
+local now = tonumber(ARGV[1])
+local ttl = tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now + ttl, ARGV[4])
+redis.call('EXPIRE', KEYS[1], math.ceil(ttl) + 1)
+return 1
+"""
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class RenderPoolSaturated(Exception):
+    """
+    Raised when a render cannot be admitted or did not finish in time
+    """
+    def __init__(self, message, retry_after=DEFAULT_RETRY_AFTER):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _acquire_slot(cache, key, limit, token, ttl):
+    return bool(cache.eval(ACQUIRE_SLOT_SCRIPT, 1, key, time.time(), limit, ttl, token))
+
+
+class RenderPool:
+    """
+    Bounded executor for watermark renders.
+
+    The limits hold across every worker process and host sharing the cache:
+    at most `max_workers` renders run at once and at most `queue_depth` more
+    wait for a slot; anything beyond that is refused immediately so the
+    calling worker can answer with a 503 instead of stalling. A render keeps
+    its slot until it actually finishes, even when its caller gave up on it.
+    """
+    def __init__(self, max_workers, queue_depth, timeout, retry_after, slot_ttl):
+        self.max_workers = max_workers
+        self.queue_depth = queue_depth
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.slot_ttl = slot_ttl
+        self.pid = os.getpid()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gallery-render")
+        self._lock = threading.Lock()
+        self._published_at = 0
+        self.stats = {
+            "queued": 0,
+            "active": 0,
+            "max_queued": 0,
+            "submitted": 0,
+            "rejected": 0,
+            "timed_out": 0,
+            "completed": 0,
+            "failed": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+            "render_time_total": 0.0,
+            "render_time_max": 0.0,
+            "render_memory_last": 0,
+            "render_memory_max": 0,
+        }
+
+    def _reject(self, message, stat):
+        with self._lock:
+            self.stats[stat] += 1
+        raise RenderPoolSaturated(message, self.retry_after)
+
+    def _admit(self, cache, keys, deadline):
+        """
+        Take a queue slot, then wait for a running slot until `deadline`.
+        Returns the token holding both.
+        """
+        admitted_key, running_key = keys
+        token = str(uuid.uuid4())
+        if not _acquire_slot(cache, admitted_key, self.max_workers + self.queue_depth, token, self.slot_ttl):
+            self._reject("Render queue is full", "rejected")
+
+        with self._lock:
+            self.stats["submitted"] += 1
+            self.stats["queued"] += 1
+            self.stats["max_queued"] = max(self.stats["max_queued"], self.stats["queued"])
+        try:
+            while not _acquire_slot(cache, running_key, self.max_workers, token, self.slot_ttl):
+                if time.monotonic() >= deadline:
+                    self._reject("Render did not finish in time", "timed_out")
+                time.sleep(SLOT_POLL_INTERVAL)
+        except BaseException:
+            with self._lock:
+                self.stats["queued"] -= 1
+            cache.zrem(admitted_key, token)
+            raise
+        return token
+
+    def submit(self, fn, *args, **kwargs):
+        return self._submit(time.monotonic() + self.timeout, fn, args, kwargs)
+
+    def _submit(self, deadline, fn, args, kwargs):
+        submitted_at = time.monotonic()
+        # Keys are made here: render threads have no site context
+        cache = frappe.cache()
+        keys = (cache.make_key(ADMITTED_KEY), cache.make_key(RUNNING_KEY))
+        token = self._admit(cache, keys, deadline)
+
+        def run():
+            started_at = time.monotonic()
+            wait_time = started_at - submitted_at
+            with self._lock:
+                self.stats["queued"] -= 1
+                self.stats["active"] += 1
+                self.stats["wait_time_total"] += wait_time
+                self.stats["wait_time_max"] = max(self.stats["wait_time_max"], wait_time)
+            failed = True
+            try:
+                result = fn(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                render_time = time.monotonic() - started_at
+                with self._lock:
+                    self.stats["active"] -= 1
+                    self.stats["failed" if failed else "completed"] += 1
+                    self.stats["render_time_total"] += render_time
+                    self.stats["render_time_max"] = max(self.stats["render_time_max"], render_time)
+                self._release(cache, keys, token)
+
+        try:
+            return self._executor.submit(run)
+        except Exception:
+            with self._lock:
+                self.stats["queued"] -= 1
+            self._release(cache, keys, token)
+            raise
+
+    def _release(self, cache, keys, token):
+        try:
+            pipe = cache.pipeline(transaction=False)
+            for key in keys:
+                pipe.zrem(key, token)
+            pipe.execute()
+        except Exception:
+            # The slots expire on their own after slot_ttl
+            pass
+
+    def render(self, fn, *args, **kwargs):
+        """
+        Run `fn` on the pool and wait for its result. Time spent waiting for
+        a slot counts against the same timeout as the render itself.
+        """
+        deadline = time.monotonic() + self.timeout
+        try:
+            future = self._submit(deadline, fn, args, kwargs)
+            try:
+                return future.result(timeout=max(0, deadline - time.monotonic()))
+            except FutureTimeoutError:
+                with self._lock:
+                    self.stats["timed_out"] += 1
+                raise RenderPoolSaturated("Render did not finish in time", self.retry_after)
+        finally:
+            self.publish_metrics()
+
+    def record_memory(self, peak_bytes):
+        with self._lock:
+            self.stats["render_memory_last"] = peak_bytes
+            self.stats["render_memory_max"] = max(self.stats["render_memory_max"], peak_bytes)
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+        finished = stats["completed"] + stats["failed"]
+        started = finished + stats["active"]
+        stats.update({
+            "pid": self.pid,
+            "max_workers": self.max_workers,
+            "queue_depth": self.queue_depth,
+            "wait_time_avg": stats["wait_time_total"] / started if started else 0.0,
+            "render_time_avg": stats["render_time_total"] / finished if finished else 0.0,
+            "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "updated_at": time.time(),
+        })
+        return stats
+
+    def publish_metrics(self, force=False):
+        """
+        Push this worker's counters to the shared cache, at most every few seconds
+        """
+        now = time.monotonic()
+        if not force and now - self._published_at < METRICS_PUBLISH_INTERVAL:
+            return
+        self._published_at = now
+        try:
+            frappe.cache().hset(METRICS_KEY, f"{socket.gethostname()}:{self.pid}", self.snapshot())
+        except Exception as e:
+            frappe.logger().warning(f"Could not publish render metrics: {str(e)}")
+
+
+def get_render_pool():
+    """
+    Return the process-wide render pool, creating it on first use (and again after a fork)
+    """
+    global _pool
+    pid = os.getpid()
+    if _pool is None or _pool.pid != pid:
+        with _pool_lock:
+            if _pool is None or _pool.pid != pid:
+                _pool = RenderPool(
+                    max_workers=max(1, int(frappe.conf.get("gallery_render_workers") or DEFAULT_WORKERS)),
+                    queue_depth=max(0, int(frappe.conf.get("gallery_render_queue_depth", DEFAULT_QUEUE_DEPTH))),
+                    timeout=float(frappe.conf.get("gallery_render_timeout") or DEFAULT_TIMEOUT),
+                    retry_after=int(frappe.conf.get("gallery_render_retry_after") or DEFAULT_RETRY_AFTER),
+                    slot_ttl=int(frappe.conf.get("gallery_render_slot_ttl") or DEFAULT_SLOT_TTL),
+                )
+    return _pool
+
+
+def render(fn, *args, **kwargs):
+    """
+    Run a watermark render through the bounded pool.
+    Raises RenderPoolSaturated when the pool is full or the render times out.
+    """
+    return get_render_pool().render(fn, *args, **kwargs)
+
+
+def record_render_memory(peak_bytes):
+    """
+    Record the estimated peak pixel-buffer memory of a render on this worker's pool
+    """
+    if _pool is not None and _pool.pid == os.getpid():
+        _pool.record_memory(peak_bytes)
+
+
+@frappe.whitelist()
+def get_render_metrics():
+    """
+    API endpoint to get render pool metrics for every worker (for admin/monitoring)
+    Requires authentication
+    """
+    try:
+        get_render_pool().publish_metrics(force=True)
+        workers = frappe.cache().hgetall(METRICS_KEY) or {}
+        workers = {
+            (key.decode() if isinstance(key, bytes) else key): value
+            for key, value in workers.items()
+        }
+        # Drop entries left behind by workers that have since been recycled
+        stale = [key for key, value in workers.items() if time.time() - value.get("updated_at", 0) > METRICS_STALE_AFTER]
+        for key in stale:
+            frappe.cache().hdel(METRICS_KEY, key)
+            workers.pop(key)
+        return {
+            "success": True,
+            "totals": {
+                "queued": sum(w.get("queued", 0) for w in workers.values()),
+                "active": sum(w.get("active", 0) for w in workers.values()),
+                "rejected": sum(w.get("rejected", 0) for w in workers.values()),
+                "timed_out": sum(w.get("timed_out", 0) for w in workers.values()),
+                "wait_time_max": max((w.get("wait_time_max", 0.0) for w in workers.values()), default=0.0),
+                "render_memory_max": max((w.get("render_memory_max", 0) for w in workers.values()), default=0),
+            },
+            "workers": workers
+        }
+    except Exception as e:
+        frappe.log_error(f"Error getting render metrics: {str(e)}")
+        return {"success": False, "message": "Error retrieving render metrics", "error": str(e)}
@@ -5,6 +5,28 @@ import json
 from frappe import _
 from frappe.utils import now_datetime, add_to_date
 import hashlib
+import pickle
+
+SESSION_ACTIVE_INDEX = "gallery_sessions:active"
+SESSION_USAGE_INDEX = "gallery_sessions:usage"
+SESSION_IP_LIST = "gallery_sessions:ips"
+SESSION_TTL = 7200
+
+
+def session_usage_key(session_token):
+    """
+    Image request counter of a session. Kept apart from the session data so
+    counting a request never writes the session back over a revoke.
+    """
+    return f"gallery_session_usage:{session_token}"
+
+
+def get_session_max_requests():
+    """
+    Image requests allowed per viewing session; 0 (the default) means no limit.
+    Listings and thumbnails count too, so size it above the largest gallery.
+    """
+    return max(0, frappe.utils.cint(frappe.conf.get("gallery_session_max_requests")))
 
 @frappe.whitelist(allow_guest=True)
 def create_viewing_session():
@@ -41,14 +63,14 @@ def create_viewing_session():
             "expires_at": expires_at.isoformat(),
             "client_ip": client_ip,
             "user_agent": user_agent,
-            "image_requests": 0,  # Counter for rate limiting
-            "max_requests": 200,  # Max 200 image requests per session
+            "max_requests": get_session_max_requests(),  # 0 means unlimited
             "is_active": True
         }
         
         # Store session in cache (Redis if available, else database)
         cache_key = f"session_token:{session_token}"
         frappe.cache().set_value(cache_key, json.dumps(session_data), expires_in_sec=7200)  # 2 hours
+        index_session(session_data)
         
         # Log session creation
         frappe.logger().info(f"Viewing session created: {session_token} for IP: {client_ip}")
@@ -58,7 +80,7 @@ def create_viewing_session():
             "session_token": session_token,
             "expires_at": expires_at.isoformat(),
             "expires_in_seconds": 7200,
-            "max_image_requests": 200,
+            "max_image_requests": get_session_max_requests(),
             "message": "Viewing session created successfully"
         }
         
@@ -75,22 +97,24 @@ def increment_session_usage(session_token):
     Increment the image request counter for a session
     """
     try:
-        cache_key = f"viewing_session:{session_token}"
-        session_data_str = frappe.cache().get_value(cache_key)
-        
-        if session_data_str:
-            session_data = json.loads(session_data_str)
-            session_data["image_requests"] = session_data.get("image_requests", 0) + 1
-            
-            # Update cache with new counter
-            frappe.cache().set_value(cache_key, json.dumps(session_data), expires_in_sec=7200)
-            
-            return session_data["image_requests"]
+        cache = frappe.cache()
+        usage_key = cache.make_key(session_usage_key(session_token))
+        pipe = cache.pipeline(transaction=False)
+        pipe.incr(usage_key)
+        pipe.expire(usage_key, SESSION_TTL)
+        # XX: a request finishing after a revoke must not add the session back
+        pipe.zadd(cache.make_key(SESSION_USAGE_INDEX), {session_token: 1}, xx=True, incr=True)
+        return pipe.execute()[0]
     except Exception as e:
         frappe.log_error(f"Error incrementing session usage: {str(e)}")
     
     return 0
 
+
+def get_session_usage(session_token):
+    cache = frappe.cache()
+    return int(cache.get(cache.make_key(session_usage_key(session_token))) or 0)
+
 def check_session_rate_limit(client_ip):
     """
     Check if IP has exceeded session creation rate limit
@@ -121,7 +145,7 @@ def get_session_stats(session_token):
     Requires authentication
     """
     try:
-        cache_key = f"viewing_session:{session_token}"
+        cache_key = f"session_token:{session_token}"
         session_data_str = frappe.cache().get_value(cache_key)
         
         if not session_data_str:
@@ -139,7 +163,7 @@ def get_session_stats(session_token):
                 "created_at": session_data["created_at"],
                 "expires_at": session_data["expires_at"],
                 "client_ip": session_data["client_ip"],
-                "image_requests": session_data.get("image_requests", 0),
+                "image_requests": get_session_usage(session_token),
                 "max_requests": session_data.get("max_requests", 200),
                 "is_active": session_data.get("is_active", True)
             }
@@ -159,7 +183,7 @@ def revoke_viewing_session(session_token):
     Requires authentication
     """
     try:
-        cache_key = f"viewing_session:{session_token}"
+        cache_key = f"session_token:{session_token}"
         session_data_str = frappe.cache().get_value(cache_key)
         
         if not session_data_str:
@@ -173,6 +197,7 @@ def revoke_viewing_session(session_token):
         
         # Update cache
         frappe.cache().set_value(cache_key, json.dumps(session_data), expires_in_sec=7200)
+        deindex_session(session_data)
         
         frappe.logger().info(f"Viewing session revoked: {session_token}")
         
@@ -213,6 +238,8 @@ def refresh_viewing_session():
         
     # Update cache
     frappe.cache().set_value(cache_key, json.dumps(session_data), expires_in_sec=7200)
+    frappe.cache().expire(frappe.cache().make_key(session_usage_key(session_token)), SESSION_TTL)
+    index_session(session_data)
         
     return {
         "success": True,
@@ -240,45 +267,300 @@ def validate_viewing_session_internal(session_token):
         cache_key = f"session_token:{session_token}"
         session_data_str = frappe.cache().get_value(cache_key)
 
-        if not session_data_str:
-            return {
-                "valid": False,
-                "message": "Session not found or expired"
-            }
+        result = check_session_data(session_data_str, get_session_usage(session_token))
+        if result.get("expired"):
+            frappe.cache().delete_value(cache_key)
+            deindex_session(json.loads(session_data_str))
+        return result
 
-        session_data = json.loads(session_data_str)
+    except Exception as e:
+        frappe.log_error(f"Error validating session: {str(e)}")
+        return {
+            "valid": False,
+            "message": "Error validating session",
+            "description":{str(e)}
+        }
 
-        if not session_data.get("is_active", False):
-            return {
-                "valid": False,
-                "message": "Session has been deactivated"
-            }
 
-        expires_at = frappe.utils.get_datetime(session_data["expires_at"])
-        if now_datetime() > expires_at:
-            frappe.cache().delete_value(cache_key)
-            return {
-                "valid": False,
-                "message": "Session has expired"
-            }
+def check_session_data(session_data_str, image_requests=0):
+    """
+    Validate stored session data and its request count without touching the
+    cache, so other servers can share the rules (see image_server). Sets
+    `expired` when the caller should delete the session.
+    """
+    if not session_data_str:
+        return {
+            "valid": False,
+            "message": "Session not found or expired"
+        }
 
-        if session_data.get("image_requests", 0) >= session_data.get("max_requests", 200):
-            return {
-                "valid": False,
-                "message": "Session request limit exceeded"
-            }
+    session_data = json.loads(session_data_str)
 
+    if not session_data.get("is_active", False):
         return {
-            "valid": True,
-            "session_data": session_data,
-            "message": "Session is valid"
+            "valid": False,
+            "message": "Session has been deactivated"
         }
 
-    except Exception as e:
-        frappe.log_error(f"Error validating session: {str(e)}")
+    expires_at = frappe.utils.get_datetime(session_data["expires_at"])
+    if now_datetime() > expires_at:
         return {
             "valid": False,
-            "message": "Error validating session",
-            "description":{str(e)}
+            "expired": True,
+            "message": "Session has expired"
+        }
+
+    max_requests = get_session_max_requests()
+    if max_requests and image_requests >= max_requests:
+        return {
+            "valid": False,
+            "message": "Session request limit exceeded"
+        }
+
+    return {
+        "valid": True,
+        "session_data": session_data,
+        "message": "Session is valid"
+    }
+
+
+def _ip_index(client_ip):
+    return f"gallery_sessions:ip:{client_ip}"
+
+
+def _user_agent_index(user_agent):
+    return f"gallery_sessions:ua:{hashlib.sha1((user_agent or 'unknown').encode()).hexdigest()[:16]}"
+
+
+def _expiry_timestamp(session_data):
+    return frappe.utils.get_datetime(session_data["expires_at"]).timestamp()
+
+
+def index_session(session_data):
+    """
+    Add a session to the sorted-set indexes used by the admin endpoints.
+    Every index is scored by expiry time so expired entries can be cut with
+    ZREMRANGEBYSCORE instead of scanning keys.
+    """
+    cache = frappe.cache()
+    token = session_data["token"]
+    expires = _expiry_timestamp(session_data)
+    ip_key = cache.make_key(_ip_index(session_data.get("client_ip")))
+    ua_key = cache.make_key(_user_agent_index(session_data.get("user_agent")))
+
+    pipe = cache.pipeline(transaction=False)
+    pipe.zadd(cache.make_key(SESSION_ACTIVE_INDEX), {token: expires})
+    pipe.zadd(ip_key, {token: expires})
+    pipe.expire(ip_key, SESSION_TTL)
+    pipe.zadd(ua_key, {token: expires})
+    pipe.expire(ua_key, SESSION_TTL)
+    pipe.zadd(cache.make_key(SESSION_IP_LIST), {session_data.get("client_ip"): expires}, gt=True)
+    pipe.zadd(cache.make_key(SESSION_USAGE_INDEX), {token: 0}, nx=True)
+    pipe.execute()
+
+
+def deindex_session(session_data):
+    cache = frappe.cache()
+    token = session_data["token"]
+    pipe = cache.pipeline(transaction=False)
+    pipe.zrem(cache.make_key(SESSION_ACTIVE_INDEX), token)
+    pipe.zrem(cache.make_key(SESSION_USAGE_INDEX), token)
+    pipe.zrem(cache.make_key(_ip_index(session_data.get("client_ip"))), token)
+    pipe.zrem(cache.make_key(_user_agent_index(session_data.get("user_agent"))), token)
+    pipe.execute()
+
+
+def prune_session_indexes():
+    """
+    Scheduled job: drop expired sessions from the global indexes
+    """
+    cache = frappe.cache()
+    now = time.time()
+    active_key = cache.make_key(SESSION_ACTIVE_INDEX)
+    usage_key = cache.make_key(SESSION_USAGE_INDEX)
+
+    # Expired tokens leave the usage index in batches; no KEYS or full scans
+    while True:
+        expired = cache.zrangebyscore(active_key, "-inf", now, start=0, num=500)
+        if not expired:
+            break
+        pipe = cache.pipeline(transaction=False)
+        pipe.zrem(active_key, *expired)
+        pipe.zrem(usage_key, *expired)
+        pipe.execute()
+
+    cache.zremrangebyscore(cache.make_key(SESSION_IP_LIST), "-inf", now)
+
+
+def _load_sessions(tokens):
+    """
+    Fetch session data and request counts for many tokens in one round trip
+    """
+    if not tokens:
+        return []
+    cache = frappe.cache()
+    tokens = [_decode(token) for token in tokens]
+    keys = [cache.make_key(f"session_token:{token}") for token in tokens]
+    usage_keys = [cache.make_key(session_usage_key(token)) for token in tokens]
+    values = cache.mget(keys + usage_keys)
+    sessions = []
+    for value, image_requests in zip(values[:len(tokens)], values[len(tokens):]):
+        if value is not None:
+            session_data = json.loads(pickle.loads(value))
+            session_data["image_requests"] = int(image_requests or 0)
+            sessions.append(session_data)
+    return sessions
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _session_id(token):
+    """
+    Stable identifier for a session in admin listings; the token itself
+    grants image access and is never returned
+    """
+    return hashlib.sha256(token.encode()).hexdigest()[:16]
+
+
+def _session_summary(session_data):
+    return {
+        "session_id": _session_id(session_data["token"]),
+        "created_at": session_data["created_at"],
+        "expires_at": session_data["expires_at"],
+        "client_ip": session_data["client_ip"],
+        "user_agent": session_data.get("user_agent"),
+        "image_requests": session_data.get("image_requests", 0),
+        "max_requests": session_data.get("max_requests", 200),
+        "is_active": session_data.get("is_active", True)
+    }
+
+
+@frappe.whitelist()
+def list_active_sessions(start=0, page_length=50, client_ip=None):
+    """
+    Page through active viewing sessions, optionally for one IP (admin only)
+    Requires System Manager
+    """
+    frappe.only_for("System Manager")
+    try:
+        cache = frappe.cache()
+        start = frappe.utils.cint(start)
+        page_length = min(frappe.utils.cint(page_length) or 50, 500)
+        index = _ip_index(client_ip) if client_ip else SESSION_ACTIVE_INDEX
+        index_key = cache.make_key(index)
+
+        now = time.time()
+        total = cache.zcount(index_key, now, "+inf")
+        tokens = cache.zrangebyscore(index_key, now, "+inf", start=start, num=page_length)
+
+        return {
+            "success": True,
+            "total": total,
+            "start": start,
+            "sessions": [_session_summary(session_data) for session_data in _load_sessions(tokens)]
+        }
+
+    except Exception as e:
+        frappe.log_error(f"Error listing sessions: {str(e)}")
+        return {
+            "success": False,
+            "message": "Error listing sessions"
         }
 
+
+@frappe.whitelist()
+def get_session_overview(top=10, cursor=0, scan_count=200):
+    """
+    Aggregated session usage: active count, top consumers and sessions per
+    IP. IPs are walked with ZSCAN; pass the returned cursor back to continue.
+    Requires System Manager
+    """
+    frappe.only_for("System Manager")
+    try:
+        cache = frappe.cache()
+        top = min(frappe.utils.cint(top) or 10, 100)
+        now = time.time()
+
+        active = cache.zcount(cache.make_key(SESSION_ACTIVE_INDEX), now, "+inf")
+        top_consumers = cache.zrevrange(cache.make_key(SESSION_USAGE_INDEX), 0, top - 1, withscores=True)
+
+        next_cursor, ip_entries = cache.zscan(
+            cache.make_key(SESSION_IP_LIST), cursor=frappe.utils.cint(cursor), count=frappe.utils.cint(scan_count) or 200
+        )
+        ips = [_decode(ip) for ip, expires in ip_entries if expires > now]
+        pipe = cache.pipeline(transaction=False)
+        for ip in ips:
+            pipe.zcount(cache.make_key(_ip_index(ip)), now, "+inf")
+        sessions_per_ip = sorted(
+            ({"client_ip": ip, "active_sessions": count} for ip, count in zip(ips, pipe.execute()) if count),
+            key=lambda entry: entry["active_sessions"],
+            reverse=True
+        )
+
+        return {
+            "success": True,
+            "active_sessions": active,
+            "top_consumers": [
+                {"session_id": _session_id(_decode(token)), "image_requests": int(requests)}
+                for token, requests in top_consumers
+            ],
+            "sessions_per_ip": sessions_per_ip,
+            "cursor": next_cursor
+        }
+
+    except Exception as e:
+        frappe.log_error(f"Error getting session overview: {str(e)}")
+        return {
+            "success": False,
+            "message": "Error retrieving session overview"
+        }
+
+
+@frappe.whitelist()
+def revoke_sessions(client_ip=None, user_agent=None):
+    """
+    Revoke every active session from an IP and/or user agent (admin only)
+    Requires System Manager
+    """
+    frappe.only_for("System Manager")
+    if not client_ip and not user_agent:
+        frappe.throw(_("Provide a client IP or user agent"))
+
+    try:
+        cache = frappe.cache()
+        now = time.time()
+        tokens = None
+        for index in filter(None, [
+            _ip_index(client_ip) if client_ip else None,
+            _user_agent_index(user_agent) if user_agent else None
+        ]):
+            found = {_decode(token) for token in cache.zrangebyscore(cache.make_key(index), now, "+inf")}
+            tokens = found if tokens is None else tokens & found
+
+        revoked = 0
+        for session_data in _load_sessions(sorted(tokens)):
+            cache_key = f"session_token:{session_data['token']}"
+            session_data["is_active"] = False
+            # Counted in its own key, see session_usage_key
+            session_data.pop("image_requests", None)
+            ttl = cache.ttl(cache.make_key(cache_key))
+            cache.set_value(cache_key, json.dumps(session_data), expires_in_sec=ttl if ttl and ttl > 0 else SESSION_TTL)
+            deindex_session(session_data)
+            revoked += 1
+
+        frappe.logger().info(f"Viewing sessions revoked: {revoked} for IP: {client_ip}, user agent: {user_agent}")
+
+        return {
+            "success": True,
+            "revoked": revoked,
+            "message": f"Revoked {revoked} sessions"
+        }
+
+    except Exception as e:
+        frappe.log_error(f"Error revoking sessions: {str(e)}")
+        return {
+            "success": False,
+            "message": "Error revoking sessions"
+        }
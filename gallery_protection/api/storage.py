@@ -0,0 +1,490 @@
+"""
+Storage backends for gallery images.
+
+Images and the files derived from them (masters, layout metadata) are
+addressed by storage keys of the form
+
+    {service_id}/{folder_type}/{shard}/{filename}
+
+where `shard` is the first two hex digits of the SHA-1 of the filename, so a
+folder holds at most 256 subdirectories instead of every image of a service.
+Derived files live next to their image, e.g.
+`{service_id}/{folder_type}/{shard}/.masters/{filename}.webp`.
+
+`LocalStorage` keeps keys under `private/files/images`; `S3Storage` keeps them
+in an S3-compatible bucket (AWS, MinIO, ...). Pick one with
+`gallery_storage_backend` in site config. Backend objects hold no Frappe
+context once built, so their methods may be called from render pool threads.
+"""
+import frappe
+import hashlib
+import os
+import posixpath
+import shutil
+import threading
+import uuid
+from frappe import _
+from .file_access import RESPONSE_CHUNK_SIZE, iter_file
+from .image_store import (
+    COPY_BUFFER_SIZE, FOLDER_TYPES, get_images_root, get_storage_cache_root,
+    store_file, _remove_quietly
+)
+
+SHARD_WIDTH = 2
+S3_SETTINGS = (
+    "gallery_s3_bucket", "gallery_s3_prefix", "gallery_s3_endpoint_url",
+    "gallery_s3_region", "gallery_s3_access_key", "gallery_s3_secret_key"
+)
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_shard(filename):
+    return hashlib.sha1(filename.encode()).hexdigest()[:SHARD_WIDTH]
+
+
+def get_image_key(service_id, folder_type, filename):
+    """
+    Storage key of an image; all parts must already be validated
+    """
+    return posixpath.join(service_id, folder_type, get_shard(filename), filename)
+
+
+def is_image_key(parts):
+    # service/folder/shard/name, leaving out derived files and hidden temp files
+    return len(parts) == 4 and len(parts[2]) == SHARD_WIDTH and not parts[3].startswith(".")
+
+
+def _describe_stat(stat):
+    return {
+        "size": stat.st_size,
+        "modified": stat.st_mtime,
+        "version": f"{stat.st_mtime_ns}-{stat.st_size}"
+    }
+
+
+class LocalStorage:
+    """
+    Keys as files under a local root. Images written before sharding was
+    introduced sit directly in the folder; they are still found there until
+    `bench migrate-gallery-storage` moves them into their shard.
+    """
+    name = "local"
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def _sharded_path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def _legacy_path(self, key):
+        parts = key.split("/")
+        if len(parts) < 4:
+            return None
+        return os.path.join(self.root, parts[0], parts[1], *parts[3:])
+
+    def path(self, key):
+        """
+        Local file of a key, falling back to the pre-sharding location
+        """
+        sharded_path = self._sharded_path(key)
+        if not os.path.exists(sharded_path):
+            legacy_path = self._legacy_path(key)
+            if legacy_path and os.path.isfile(legacy_path):
+                return legacy_path
+        return sharded_path
+
+    def stat(self, key):
+        try:
+            return _describe_stat(os.stat(self.path(key)))
+        except FileNotFoundError:
+            return None
+
+    def list_services(self):
+        if not os.path.isdir(self.root):
+            return []
+        return [entry.name for entry in os.scandir(self.root) if entry.is_dir()]
+
+    def list_images(self, service_id, folder_type):
+        """
+        Yield (filename, stat) for every image of a folder
+        """
+        folder_path = os.path.join(self.root, service_id, folder_type)
+        if not os.path.isdir(folder_path):
+            return
+
+        for entry in os.scandir(folder_path):
+            if entry.name.startswith("."):
+                continue
+            if entry.is_file():
+                # Not migrated yet, unless a sharded copy already replaced it
+                if not os.path.exists(self._sharded_path(get_image_key(service_id, folder_type, entry.name))):
+                    yield entry.name, _describe_stat(entry.stat())
+            elif entry.is_dir() and len(entry.name) == SHARD_WIDTH:
+                for image_entry in os.scandir(entry.path):
+                    if image_entry.is_file() and not image_entry.name.startswith("."):
+                        yield image_entry.name, _describe_stat(image_entry.stat())
+
+    def list_derived(self, service_id, folder_type, derived_dir):
+        """
+        {name: stat} of every file in the `derived_dir` subfolders of a folder,
+        e.g. the masters and metadata sidecars in `.masters`
+        """
+        folder_path = os.path.join(self.root, service_id, folder_type)
+        if not os.path.isdir(folder_path):
+            return {}
+
+        # Legacy first, so a sharded copy of the same file wins
+        derived_paths = [os.path.join(folder_path, derived_dir)]
+        derived_paths += [
+            os.path.join(entry.path, derived_dir)
+            for entry in os.scandir(folder_path)
+            if entry.is_dir() and len(entry.name) == SHARD_WIDTH
+        ]
+        derived = {}
+        for derived_path in derived_paths:
+            if not os.path.isdir(derived_path):
+                continue
+            for entry in os.scandir(derived_path):
+                if entry.is_file() and not entry.name.startswith("."):
+                    derived[entry.name] = _describe_stat(entry.stat())
+        return derived
+
+    def local_path(self, key):
+        return self.path(key)
+
+    def read(self, key):
+        with open(self.path(key), 'rb') as f:
+            return f.read()
+
+    def iter_range(self, key, start=0, stop=None, chunk_size=RESPONSE_CHUNK_SIZE):
+        """
+        Yield the bytes of a key from `start` up to (not including) `stop`,
+        sliced from a memory map of the file
+        """
+        return iter_file(self.path(key), start, stop, chunk_size)
+
+    def put_file(self, source_path, key, digest=None):
+        """
+        Move a local file into place under `key`; the source is consumed.
+        Content with a SHA-256 `digest` goes through the deduplicating blob
+        store. Returns True if that content was already stored.
+        """
+        target_path = self._sharded_path(key)
+        if digest:
+            deduplicated = store_file(source_path, digest, os.path.dirname(target_path), os.path.basename(target_path))
+        else:
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            os.replace(source_path, target_path)
+            deduplicated = False
+        self._remove_legacy(key)
+        return deduplicated
+
+    def put_bytes(self, key, data):
+        target_path = self._sharded_path(key)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        temp_path = f"{target_path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, target_path)
+        self._remove_legacy(key)
+
+    def delete(self, key):
+        _remove_quietly(self._sharded_path(key))
+        self._remove_legacy(key)
+
+    def _remove_legacy(self, key):
+        # A stale pre-sharding copy would reappear once the sharded file is gone
+        legacy_path = self._legacy_path(key)
+        if legacy_path:
+            _remove_quietly(legacy_path)
+
+
+class S3Storage:
+    """
+    Keys as objects in an S3-compatible bucket. Reads stream from the object
+    and support byte ranges; Pillow gets a local copy kept in a read-through
+    cache under `private/files/gallery_storage_cache`, keyed by ETag.
+    """
+    name = "s3"
+
+    def __init__(self, bucket, prefix="", endpoint_url=None, region=None, access_key=None, secret_key=None, cache_root=None):
+        try:
+            import boto3
+            from botocore.exceptions import ClientError
+        except ImportError:
+            frappe.throw(_("The S3 storage backend needs boto3 installed in the bench environment"))
+
+        if not bucket:
+            frappe.throw(_("gallery_s3_bucket must be set to use the S3 storage backend"))
+
+        self.bucket = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix and prefix.strip("/") else ""
+        self.cache_root = os.path.abspath(cache_root or get_storage_cache_root())
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=endpoint_url or None,
+            region_name=region or None,
+            aws_access_key_id=access_key or None,
+            aws_secret_access_key=secret_key or None
+        )
+        self._client_error = ClientError
+
+    def _object_key(self, key):
+        return self.prefix + key
+
+    def _is_missing(self, error):
+        return error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+    def _head(self, key):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))
+        except self._client_error as e:
+            if self._is_missing(e):
+                return None
+            raise
+
+    def stat(self, key):
+        head = self._head(key)
+        if head is None:
+            return None
+        return {
+            "size": head["ContentLength"],
+            "modified": head["LastModified"].timestamp(),
+            "version": head["ETag"].strip('"')
+        }
+
+    def list_services(self):
+        paginator = self.client.get_paginator("list_objects_v2")
+        services = []
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix, Delimiter="/"):
+            for common_prefix in page.get("CommonPrefixes", []):
+                services.append(common_prefix["Prefix"][len(self.prefix):].rstrip("/"))
+        return services
+
+    def list_images(self, service_id, folder_type):
+        paginator = self.client.get_paginator("list_objects_v2")
+        folder_prefix = self._object_key(f"{service_id}/{folder_type}/")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=folder_prefix):
+            for item in page.get("Contents", []):
+                parts = item["Key"][len(self.prefix):].split("/")
+                if is_image_key(parts):
+                    yield parts[3], {
+                        "size": item["Size"],
+                        "modified": item["LastModified"].timestamp(),
+                        "version": item["ETag"].strip('"')
+                    }
+
+    def list_derived(self, service_id, folder_type, derived_dir):
+        """
+        {name: stat} of every object in the `derived_dir` subfolders of a
+        folder, from one paginated listing
+        """
+        paginator = self.client.get_paginator("list_objects_v2")
+        folder_prefix = self._object_key(f"{service_id}/{folder_type}/")
+        derived = {}
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=folder_prefix):
+            for item in page.get("Contents", []):
+                parts = item["Key"][len(self.prefix):].split("/")
+                if len(parts) == 5 and parts[3] == derived_dir:
+                    derived[parts[4]] = {
+                        "size": item["Size"],
+                        "modified": item["LastModified"].timestamp(),
+                        "version": item["ETag"].strip('"')
+                    }
+        return derived
+
+    def local_path(self, key):
+        """
+        Path of a local copy of the object, downloaded on first use
+        """
+        stat = self.stat(key)
+        if stat is None:
+            raise FileNotFoundError(key)
+
+        key_hash = hashlib.sha1(key.encode()).hexdigest()
+        cached_path = os.path.join(self.cache_root, key_hash[:SHARD_WIDTH], f"{key_hash}-{stat['version']}")
+        try:
+            # Touched on use so the cache pruning job keeps what is still read
+            os.utime(cached_path)
+            return cached_path
+        except FileNotFoundError:
+            pass
+
+        os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+        temp_path = f"{cached_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            self.client.download_file(self.bucket, self._object_key(key), temp_path)
+            os.replace(temp_path, cached_path)
+        except BaseException:
+            _remove_quietly(temp_path)
+            raise
+        return cached_path
+
+    def _get_body(self, key, byte_range=None):
+        request = {"Bucket": self.bucket, "Key": self._object_key(key)}
+        if byte_range:
+            request["Range"] = byte_range
+        try:
+            return self.client.get_object(**request)["Body"]
+        except self._client_error as e:
+            if self._is_missing(e):
+                raise FileNotFoundError(key)
+            raise
+
+    def read(self, key):
+        body = self._get_body(key)
+        try:
+            return body.read()
+        finally:
+            body.close()
+
+    def iter_range(self, key, start=0, stop=None, chunk_size=COPY_BUFFER_SIZE):
+        """
+        Yield the bytes of a key from `start` up to (not including) `stop`,
+        fetched with a ranged GET and streamed as they arrive
+        """
+        byte_range = f"bytes={start}-{'' if stop is None else stop - 1}" if start or stop is not None else None
+        body = self._get_body(key, byte_range)
+        try:
+            yield from body.iter_chunks(chunk_size)
+        finally:
+            body.close()
+
+    def put_file(self, source_path, key, digest=None):
+        """
+        Upload a local file under `key`; the source is consumed. When the
+        object already holds content with the same SHA-256 the upload is
+        skipped and True is returned.
+        """
+        try:
+            if digest:
+                head = self._head(key)
+                if head and head.get("Metadata", {}).get("sha256") == digest:
+                    return True
+            extra_args = {"Metadata": {"sha256": digest}} if digest else None
+            self.client.upload_file(source_path, self.bucket, self._object_key(key), ExtraArgs=extra_args)
+            return False
+        finally:
+            _remove_quietly(source_path)
+
+    def put_bytes(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=self._object_key(key), Body=data)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._object_key(key))
+
+
+def _build_backend(backend_name):
+    if backend_name == "s3":
+        return S3Storage(
+            bucket=frappe.conf.get("gallery_s3_bucket"),
+            prefix=frappe.conf.get("gallery_s3_prefix") or "",
+            endpoint_url=frappe.conf.get("gallery_s3_endpoint_url"),
+            region=frappe.conf.get("gallery_s3_region"),
+            access_key=frappe.conf.get("gallery_s3_access_key"),
+            secret_key=frappe.conf.get("gallery_s3_secret_key")
+        )
+    if backend_name == "local":
+        return LocalStorage(get_images_root())
+    frappe.throw(_("Unknown gallery storage backend: {0}").format(backend_name))
+
+
+def get_storage(backend_name=None):
+    """
+    Storage backend configured for the current site, built once per process
+    """
+    backend_name = backend_name or frappe.conf.get("gallery_storage_backend") or "local"
+    settings = tuple(frappe.conf.get(key) for key in S3_SETTINGS) if backend_name == "s3" else ()
+    cache_key = (os.getpid(), frappe.local.site, backend_name, settings)
+
+    with _backends_lock:
+        backend = _backends.get(cache_key)
+    if backend is None:
+        backend = _build_backend(backend_name)
+        with _backends_lock:
+            backend = _backends.setdefault(cache_key, backend)
+    return backend
+
+
+def reshard_local_images():
+    """
+    Move images and their derived files from the flat pre-sharding layout
+    into shard subdirectories. Safe to run again; returns the number moved.
+    """
+    from .normalizer import get_master_key
+    from .placeholders import get_meta_key
+
+    root = get_images_root()
+    if not os.path.isdir(root):
+        return 0
+
+    storage = LocalStorage(root)
+    moved = 0
+    for service in os.listdir(root):
+        for folder_type in FOLDER_TYPES:
+            folder_path = os.path.join(root, service, folder_type)
+            if not os.path.isdir(folder_path):
+                continue
+            for entry in list(os.scandir(folder_path)):
+                if not entry.is_file() or entry.name.startswith("."):
+                    continue
+                image_key = get_image_key(service, folder_type, entry.name)
+                master_key = get_master_key(image_key)
+                # Derived files first: the image is only published once they are in place
+                for key in (master_key, get_meta_key(master_key)):
+                    legacy_path = storage._legacy_path(key)
+                    if os.path.isfile(legacy_path):
+                        target_path = storage._sharded_path(key)
+                        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+                        os.replace(legacy_path, target_path)
+                target_path = storage._sharded_path(image_key)
+                os.makedirs(os.path.dirname(target_path), exist_ok=True)
+                os.replace(entry.path, target_path)
+                moved += 1
+            legacy_masters = os.path.join(folder_path, ".masters")
+            if os.path.isdir(legacy_masters) and not os.listdir(legacy_masters):
+                os.rmdir(legacy_masters)
+    return moved
+
+
+def copy_images(source, target, service_id=None):
+    """
+    Copy every image and its derived files from one backend to another.
+    Keys already present in the target with the same size are skipped.
+    Returns (copied, skipped).
+    """
+    from .normalizer import get_render_source, copy_sidecar
+
+    copied = skipped = 0
+    services = [service_id] if service_id else source.list_services()
+    for service in services:
+        for folder_type in FOLDER_TYPES:
+            for filename, stat in list(source.list_images(service, folder_type)):
+                image_key = get_image_key(service, folder_type, filename)
+                # Image first: the copied sidecar names its version in the target
+                copies = [_copy_key(source, target, image_key, stat)]
+                master_key = get_render_source(source, image_key, stat)
+                # Stale masters stay behind; backfill_masters builds them in the target
+                if master_key != image_key:
+                    copies.append(_copy_key(source, target, master_key, source.stat(master_key)))
+                    copies.append(copy_sidecar(source, target, image_key))
+                copied += sum(copies)
+                skipped += len(copies) - sum(copies)
+    return copied, skipped
+
+
+def _copy_key(source, target, key, key_stat):
+    """
+    Copy one key unless the target has it with the same size. Returns True
+    if it was copied.
+    """
+    existing = target.stat(key)
+    if existing and existing["size"] == key_stat["size"]:
+        return False
+    temp_path = os.path.join(get_storage_cache_root(), f".{uuid.uuid4().hex}.tmp")
+    os.makedirs(os.path.dirname(temp_path), exist_ok=True)
+    shutil.copyfile(source.local_path(key), temp_path)
+    target.put_file(temp_path, key)
+    return True
@@ -0,0 +1,70 @@
+import random
+from frappe.tests.utils import FrappeTestCase
+from gallery_protection.api.duplicates import BKTree, DuplicateIndex
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+class TestBKTree(FrappeTestCase):
+    def setUp(self):
+        self.random = random.Random(42)
+        # Clusters of near values, so searches have real matches to find
+        centres = [self.random.getrandbits(64) for _i in range(50)]
+        self.values = {}
+        for index in range(2000):
+            value = self.random.choice(centres)
+            for _bit in range(self.random.randrange(8)):
+                value ^= 1 << self.random.randrange(64)
+            self.values[f"image-{index}"] = value
+
+        self.tree = BKTree()
+        for name, value in self.values.items():
+            self.tree.add(value, name)
+
+    def brute_force(self, query, max_distance):
+        return {
+            (name, hamming(value, query))
+            for name, value in self.values.items()
+            if hamming(value, query) <= max_distance
+        }
+
+    def test_search_matches_brute_force(self):
+        queries = list(self.values.values())[:50] + [self.random.getrandbits(64) for _i in range(50)]
+        for query in queries:
+            for max_distance in (0, 3, 6, 10):
+                with self.subTest(query=query, max_distance=max_distance):
+                    self.assertEqual(set(self.tree.search(query, max_distance)), self.brute_force(query, max_distance))
+
+    def test_identical_values_share_a_node(self):
+        tree = BKTree()
+        tree.add(0xff, "a")
+        tree.add(0xff, "b")
+        self.assertEqual(sorted(tree.search(0xff, 0)), [("a", 0), ("b", 0)])
+
+    def test_remove(self):
+        for name in list(self.values)[:500]:
+            self.tree.remove(self.values.pop(name), name)
+        for query in list(self.values.values())[:20]:
+            self.assertEqual(set(self.tree.search(query, 6)), self.brute_force(query, 6))
+
+    def test_empty_tree(self):
+        self.assertEqual(list(BKTree().search(0, 64)), [])
+
+
+class TestDuplicateIndex(FrappeTestCase):
+    def test_find_sorts_and_excludes(self):
+        index = DuplicateIndex(1, {"a.jpg": "00000000000000ff", "b.jpg": "00000000000000fe", "c.jpg": "ffffffffffffffff"})
+        self.assertEqual(
+            index.find("00000000000000ff", 6),
+            [{"name": "a.jpg", "distance": 0}, {"name": "b.jpg", "distance": 1}]
+        )
+        self.assertEqual(index.find("00000000000000ff", 6, exclude="a.jpg"), [{"name": "b.jpg", "distance": 1}])
+
+    def test_replacing_a_hash(self):
+        index = DuplicateIndex(1, {"a.jpg": "0000000000000000"})
+        index.add("a.jpg", "ffffffffffffffff")
+        self.assertEqual(index.find("0000000000000000", 6), [])
+        index.remove("a.jpg")
+        self.assertEqual(index.find("ffffffffffffffff", 6), [])
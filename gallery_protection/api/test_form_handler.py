@@ -0,0 +1,109 @@
+import frappe
+import json
+import uuid
+from unittest.mock import patch
+from frappe.tests.utils import FrappeTestCase
+from redis import Redis
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+from gallery_protection.api.form_handler import (
+    DEAD_LETTER_KEY,
+    PROCESSING_KEY,
+    QUEUE_KEY,
+    TOKEN_BUCKET_SCRIPT,
+    flush_form_queue,
+    handle_form_submission,
+)
+
+
+class TestTokenBucket(FrappeTestCase):
+    def setUp(self):
+        self.cache = frappe.cache()
+        self.key = self.cache.make_key(f"gallery_form_bucket:test-{uuid.uuid4().hex}")
+
+    def tearDown(self):
+        self.cache.delete(self.key)
+
+    def take(self, now, rate=0.5, capacity=2):
+        allowed, retry_after = self.cache.eval(TOKEN_BUCKET_SCRIPT, 1, self.key, rate, capacity, now)
+        return int(allowed), int(retry_after)
+
+    def test_burst_then_retry_after(self):
+        self.assertEqual(self.take(1000), (1, 0))
+        self.assertEqual(self.take(1000), (1, 0))
+        # Empty bucket at 0.5 tokens per second: the next token is 2s away
+        self.assertEqual(self.take(1000), (0, 2))
+
+    def test_refill(self):
+        self.take(1000)
+        self.take(1000)
+        # Half a token after 1s: still refused, 1s to go
+        self.assertEqual(self.take(1001), (0, 1))
+        self.assertEqual(self.take(1002), (1, 0))
+        self.assertEqual(self.take(1002), (0, 2))
+
+    def test_refill_stops_at_capacity(self):
+        self.take(1000)
+        self.take(1000)
+        self.assertEqual([self.take(5000)[0] for _i in range(3)], [1, 1, 0])
+
+    def test_bucket_expires_once_full_again(self):
+        self.take(1000)
+        # capacity / rate seconds to refill completely, plus one
+        self.assertTrue(0 < self.cache.ttl(self.key) <= 5)
+
+
+class TestFormQueue(FrappeTestCase):
+    def setUp(self):
+        self.cache = frappe.cache()
+        self.keys = [self.cache.make_key(key) for key in (QUEUE_KEY, PROCESSING_KEY, DEAD_LETTER_KEY)]
+        self.cache.delete(*self.keys)
+        self.request = getattr(frappe.local, "request", None)
+        self.request_ip = getattr(frappe.local, "request_ip", None)
+        # A bucket of its own, so earlier runs do not rate limit this one
+        frappe.local.request_ip = f"test-{uuid.uuid4().hex}"
+
+    def tearDown(self):
+        self.cache.delete(*self.keys)
+        frappe.local.request = self.request
+        frappe.local.request_ip = self.request_ip
+
+    def submit(self, data):
+        frappe.local.request = Request(EnvironBuilder(method="POST", json=data).get_environ())
+        return handle_form_submission()
+
+    def form(self):
+        return {"leadName": "Test", "leadCompany": f"Test {uuid.uuid4().hex}", "leadMessage": "Hello"}
+
+    def test_submissions_are_mailed_as_one_digest(self):
+        first, second = self.form(), self.form()
+        for data in (first, second, first):
+            self.assertEqual(self.submit(data)["status"], "queued")
+
+        with patch("frappe.sendmail") as sendmail:
+            flush_form_queue(force=True)
+
+        # The repeat of the first form is not mailed again
+        sendmail.assert_called_once()
+        self.assertEqual(sendmail.call_args.kwargs["subject"], "2 New Contact Requests")
+        self.assertIn(first["leadCompany"], sendmail.call_args.kwargs["message"])
+        self.assertIn(second["leadCompany"], sendmail.call_args.kwargs["message"])
+        self.assertFalse(Redis.exists(self.cache, *self.keys))
+
+    def test_failed_batch_is_queued_again(self):
+        data = self.form()
+        self.submit(data)
+
+        with patch("frappe.sendmail", side_effect=Exception("SMTP down")), self.assertRaises(Exception):
+            flush_form_queue(force=True)
+
+        queue_key, processing_key, _dead_letter_key = self.keys
+        self.assertFalse(Redis.exists(self.cache, processing_key))
+        queued = [json.loads(item) for item in Redis.lrange(self.cache, queue_key, 0, -1)]
+        self.assertEqual([(item["data"]["leadCompany"], item["attempts"]) for item in queued], [(data["leadCompany"], 1)])
+
+        with patch("frappe.sendmail") as sendmail:
+            flush_form_queue(force=True)
+
+        sendmail.assert_called_once()
+        self.assertFalse(Redis.exists(self.cache, *self.keys))
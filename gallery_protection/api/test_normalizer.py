@@ -0,0 +1,86 @@
+import io
+import os
+import shutil
+import tempfile
+from frappe.tests.utils import FrappeTestCase
+from PIL import Image
+from gallery_protection.api.normalizer import (
+    HEADER_SIZE,
+    build_master,
+    get_image_meta,
+    get_master_key,
+    get_render_source,
+    refresh_image_meta,
+    sniff_format,
+)
+from gallery_protection.api.placeholders import encode_meta, get_meta_key
+from gallery_protection.api.storage import LocalStorage, get_image_key
+
+
+def encoded_header(image_format):
+    buffer = io.BytesIO()
+    Image.new("RGB", (8, 8), (200, 100, 50)).save(buffer, format=image_format)
+    return buffer.getvalue()[:HEADER_SIZE]
+
+
+class TestSniffFormat(FrappeTestCase):
+    def test_supported_formats(self):
+        for image_format in ("JPEG", "PNG", "GIF", "WEBP", "BMP", "TIFF"):
+            with self.subTest(image_format=image_format):
+                self.assertEqual(sniff_format(encoded_header(image_format)), image_format)
+
+    def test_big_endian_tiff(self):
+        self.assertEqual(sniff_format(b"MM\x00*\x00\x00\x00\x08"), "TIFF")
+
+    def test_webp_needs_riff_container(self):
+        header = encoded_header("WEBP")
+        self.assertEqual(sniff_format(b"RIFX" + header[4:]), None)
+        self.assertEqual(sniff_format(b"RIFF\x00\x00\x00\x00WAVEfmt "), None)
+
+    def test_not_an_image(self):
+        for header in (b"", b"%PDF-1.7\n", b"<svg xmlns=", b"GIF8", b"\x89PNG"):
+            with self.subTest(header=header):
+                self.assertIsNone(sniff_format(header))
+
+
+class TestRenderSource(FrappeTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.storage = LocalStorage(self.root)
+        self.image_key = get_image_key("test", "gallery", "photo.png")
+        self.master_key = get_master_key(self.image_key)
+        self.image_path = self.storage.local_path(self.image_key)
+        os.makedirs(os.path.dirname(self.image_path))
+        Image.new("RGB", (64, 48), (200, 100, 50)).save(self.image_path)
+
+        master_path = os.path.join(self.root, "master.webp")
+        build_master(self.image_path, master_path)
+        self.storage.put_file(master_path, self.master_key)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_master_built_from_the_image_is_used(self):
+        refresh_image_meta(self.storage, self.image_key)
+        self.assertEqual(get_render_source(self.storage, self.image_key), self.master_key)
+        self.assertEqual(get_image_meta(self.storage, self.image_key)["width"], 64)
+
+    def test_image_relinked_to_an_older_blob(self):
+        refresh_image_meta(self.storage, self.image_key)
+        # Deduplicated uploads are hard links, which keep the blob's old mtime
+        blob_path = os.path.join(self.root, "blob.png")
+        Image.new("RGB", (64, 48), (0, 0, 255)).save(blob_path)
+        os.utime(blob_path, (1_000_000_000, 1_000_000_000))
+        os.link(blob_path, os.path.join(self.root, "staged.png"))
+        os.replace(os.path.join(self.root, "staged.png"), self.image_path)
+
+        self.assertLess(self.storage.stat(self.image_key)["modified"], self.storage.stat(self.master_key)["modified"])
+        self.assertEqual(get_render_source(self.storage, self.image_key), self.image_key)
+        self.assertIsNone(get_image_meta(self.storage, self.image_key))
+
+    def test_sidecar_without_source_version(self):
+        # Written before sidecars named their source: modification times decide
+        self.storage.put_bytes(get_meta_key(self.master_key), encode_meta({"width": 64, "height": 48}))
+        self.assertEqual(get_render_source(self.storage, self.image_key), self.master_key)
+        os.utime(self.image_path, (os.path.getmtime(self.image_path) + 60,) * 2)
+        self.assertEqual(get_render_source(self.storage, self.image_key), self.image_key)
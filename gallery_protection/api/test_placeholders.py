@@ -0,0 +1,75 @@
+import base64
+import io
+import random
+from frappe.tests.utils import FrappeTestCase
+from PIL import Image
+from gallery_protection.api.placeholders import describe_image, compute_dhash, LQIP_EDGE
+
+
+class TestDescribeImage(FrappeTestCase):
+    def test_dimensions_and_dominant_color(self):
+        meta = describe_image(Image.new("RGB", (320, 200), (255, 128, 0)))
+        self.assertEqual((meta["width"], meta["height"]), (320, 200))
+        self.assertEqual(meta["dominant_color"], "#ff8000")
+
+    def test_dominant_color_is_the_average(self):
+        image = Image.new("RGB", (100, 100), (0, 0, 0))
+        image.paste((200, 200, 200), (0, 0, 50, 100))
+        self.assertEqual(describe_image(image)["dominant_color"], "#646464")
+
+    def test_lqip_is_a_tiny_webp(self):
+        lqip = describe_image(Image.new("RGB", (640, 480), (10, 20, 30)))["lqip"]
+        prefix = "data:image/webp;base64,"
+        self.assertTrue(lqip.startswith(prefix))
+        with Image.open(io.BytesIO(base64.b64decode(lqip[len(prefix):]))) as preview:
+            self.assertEqual(preview.format, "WEBP")
+            self.assertEqual(preview.size, (LQIP_EDGE, LQIP_EDGE * 3 // 4))
+
+    def test_other_modes(self):
+        for mode in ("RGBA", "L", "P"):
+            with self.subTest(mode=mode):
+                meta = describe_image(Image.new(mode, (30, 20)))
+                self.assertEqual((meta["width"], meta["height"]), (30, 20))
+                self.assertRegex(meta["dominant_color"], r"^#[0-9a-f]{6}$")
+
+
+def textured_image(seed, size=(512, 384)):
+    """
+    Smooth random photo stand-in: a small noise image scaled up
+    """
+    rng = random.Random(seed)
+    small = Image.new("RGB", (12, 9))
+    small.putdata([tuple(rng.randrange(256) for _c in range(3)) for _i in range(12 * 9)])
+    return small.resize(size, Image.BICUBIC)
+
+
+def hamming(a, b):
+    return (int(a, 16) ^ int(b, 16)).bit_count()
+
+
+class TestComputeDhash(FrappeTestCase):
+    def test_gradients(self):
+        # Bits are set where a pixel is brighter than its right neighbour
+        rising = Image.new("L", (256, 64))
+        rising.putdata([x for _y in range(64) for x in range(256)])
+        self.assertEqual(compute_dhash(rising), "0000000000000000")
+        self.assertEqual(compute_dhash(rising.transpose(Image.FLIP_LEFT_RIGHT)), "ffffffffffffffff")
+
+    def test_format(self):
+        self.assertRegex(compute_dhash(textured_image(1)), r"^[0-9a-f]{16}$")
+        self.assertEqual(describe_image(textured_image(1))["dhash"], compute_dhash(textured_image(1)))
+
+    def test_survives_rescaling_and_recompression(self):
+        for seed in range(10):
+            with self.subTest(seed=seed):
+                original = textured_image(seed)
+                buffer = io.BytesIO()
+                original.resize((200, 150), Image.LANCZOS).save(buffer, format="JPEG", quality=60)
+                with Image.open(io.BytesIO(buffer.getvalue())) as copy:
+                    self.assertLessEqual(hamming(compute_dhash(original), compute_dhash(copy)), 4)
+
+    def test_different_images_are_far_apart(self):
+        hashes = [compute_dhash(textured_image(seed)) for seed in range(10)]
+        for index, first in enumerate(hashes):
+            for second in hashes[index + 1:]:
+                self.assertGreater(hamming(first, second), 10)
@@ -0,0 +1,83 @@
+import io
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from frappe.tests.utils import FrappeTestCase
+from PIL import Image
+from gallery_protection.api.watermarker import _single_layer, _tile_pattern, render_watermark
+
+WIDTH, HEIGHT = 400, 300
+
+
+class TestWatermarkPlacement(FrappeTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.temp_dir = tempfile.mkdtemp()
+        # Opaque 100x20 logo: scaled to half the image width it is 200x40
+        cls.logo_path = os.path.join(cls.temp_dir, "logo.png")
+        Image.new("RGBA", (100, 20), (255, 0, 0, 255)).save(cls.logo_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.temp_dir, ignore_errors=True)
+        super().tearDownClass()
+
+    def profile(self, **options):
+        profile = {"mode": "single", "scale": 0.5, "opacity": 1.0, "logo_path": self.logo_path}
+        profile.update(options)
+        # Names are part of the logo and pattern cache keys
+        profile.setdefault("name", f"test-{self.id()}-{sorted(options.items())}")
+        profile.setdefault("version", "1")
+        return profile
+
+    def logo_box(self, profile):
+        return _single_layer(profile, WIDTH, HEIGHT).getchannel("A").getbbox()
+
+    def test_single_placements(self):
+        for placement, top in (("top", 0), ("upper", (HEIGHT - 40) // 4), ("center", (HEIGHT - 40) // 2)):
+            with self.subTest(placement=placement):
+                self.assertEqual(self.logo_box(self.profile(placement=placement)), (0, top, 200, top + 40))
+
+    def test_offset(self):
+        self.assertEqual(self.logo_box(self.profile(placement="upper", offset=[10, 5])), (10, 70, 210, 110))
+
+    def test_opacity(self):
+        layer = _single_layer(self.profile(opacity=0.5), WIDTH, HEIGHT)
+        self.assertEqual(layer.getchannel("A").getextrema(), (0, 127))
+
+    def test_logo_is_pasted_through_its_alpha(self):
+        # A semi-transparent logo keeps the look of the original renderer
+        logo_path = os.path.join(self.temp_dir, "faint.png")
+        Image.new("RGBA", (100, 20), (255, 0, 0, 151)).save(logo_path)
+        layer = _single_layer(self.profile(logo_path=logo_path), WIDTH, HEIGHT)
+
+        expected = Image.new("RGBA", (1, 1), (0, 0, 0, 0))
+        dot = Image.new("RGBA", (1, 1), (255, 0, 0, 151))
+        expected.paste(dot, (0, 0), dot)
+        self.assertEqual(layer.getpixel((100, 20)), expected.getpixel((0, 0)))
+
+    def test_tiled_covers_the_image(self):
+        pattern = _tile_pattern(self.profile(mode="tiled", scale=0.3, spacing=0.25), WIDTH, HEIGHT)
+        self.assertEqual(pattern.size, (WIDTH, HEIGHT))
+        self.assertEqual(pattern.getchannel("A").getbbox(), (0, 0, WIDTH, HEIGHT))
+
+    def test_render_keeps_size_and_format(self):
+        image_path = os.path.join(self.temp_dir, "photo.png")
+        Image.new("RGB", (WIDTH, HEIGHT), (0, 0, 255)).save(image_path)
+        content = render_watermark(image_path, self.profile(placement="top"))
+        with Image.open(io.BytesIO(content)) as rendered:
+            self.assertEqual((rendered.format, rendered.size), ("PNG", (WIDTH, HEIGHT)))
+            self.assertEqual(rendered.getpixel((10, 10)), (255, 0, 0))
+            self.assertEqual(rendered.getpixel((10, 100)), (0, 0, 255))
+
+    def test_tiled_render_off_the_request_thread(self):
+        # Render pool threads have no site context
+        image_path = os.path.join(self.temp_dir, "tiled.png")
+        Image.new("RGB", (WIDTH, HEIGHT), (0, 0, 255)).save(image_path)
+        profile = self.profile(mode="tiled", scale=0.3, spacing=0.25)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            content = executor.submit(render_watermark, image_path, profile).result()
+        with Image.open(io.BytesIO(content)) as rendered:
+            self.assertEqual(rendered.size, (WIDTH, HEIGHT))
@@ -1,119 +1,273 @@
-from PIL import Image, ImageDraw, ImageFont, ImageFilter
+from PIL import Image, ImageFilter
+from collections import OrderedDict
+import copy
+import hashlib
 import io
+import json
+import math
 import os
+import threading
 import frappe
-
-def add_watermark(image_path: str, wmark_path: str = "amanksolutions.png") -> bytes:
-    original_image = Image.open(image_path)
-    original_format = original_image.format
-    image = original_image.convert("RGBA")
-    width, height = image.size
-
+from .render_pool import record_render_memory
+from .normalizer import DEFAULT_MAX_IMAGE_PIXELS, get_max_image_pixels
+
+DEFAULT_LOGO = "amanksolutions.png"
+TILE_BUCKET = 256
+MAX_CACHED_LOGOS = 16
+# Each cached pattern is a full RGBA layer (about 26 MB for a 2560px bucket)
+DEFAULT_CACHED_PATTERNS = 2
+DEFAULT_RENDER_MAX_EDGE = 2560
+# Part of every render cache key; raise it when the renderer's output changes
+RENDERER_VERSION = 2
+
+# placement: where a single logo goes vertically; offset is added in pixels
+# scale: logo width relative to image width
+# spacing (tiled only): gap between tiles relative to the logo size, at least 0
+# trim: crop the logo's transparent border before scaling
+BUILTIN_PROFILES = {
+    "full": {
+        "mode": "single",
+        "placement": "top",
+        "offset": [0, 0],
+        "scale": 1.05,
+        "opacity": 1.0,
+        "logo": DEFAULT_LOGO,
+    },
+    "half": {
+        "mode": "single",
+        "placement": "upper",
+        "offset": [-10, 50],
+        "scale": 1.05,
+        "opacity": 1.0,
+        "logo": DEFAULT_LOGO,
+    },
+    "tiled": {
+        "mode": "tiled",
+        "scale": 0.3,
+        "spacing": 0.25,
+        "trim": True,
+        "opacity": 0.5,
+        "logo": DEFAULT_LOGO,
+    },
+}
+DEFAULT_PROFILE = "full"
+
+_logo_cache = OrderedDict()
+_pattern_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+class ImageTooLarge(Exception):
+    """
+    Raised when an image has more pixels than the render path accepts
+    """
+
+
+def get_watermark_profile(service_id=None, name=None):
+    """
+    Resolve the watermark profile for a service.
+
+    Profiles come from BUILTIN_PROFILES, overridden or extended by
+    `gallery_watermark_profiles` in site config; services are mapped to a
+    profile by `gallery_service_watermark_profiles`. Must be called in the
+    request context, the returned dict is all the renderer needs.
+    """
+    if not name:
+        service_profiles = frappe.conf.get("gallery_service_watermark_profiles") or {}
+        name = service_profiles.get(service_id) or frappe.conf.get("gallery_default_watermark_profile") or DEFAULT_PROFILE
+
+    configured = frappe.conf.get("gallery_watermark_profiles") or {}
+    if name not in configured and name not in BUILTIN_PROFILES:
+        name = DEFAULT_PROFILE
+
+    profile = copy.deepcopy(BUILTIN_PROFILES.get(name, BUILTIN_PROFILES[DEFAULT_PROFILE]))
+    profile.update(configured.get(name) or {})
+    profile["name"] = name
+
+    # Any change to the profile yields a new version and so new render cache keys
+    if not profile.get("version"):
+        profile["version"] = hashlib.sha1(json.dumps(profile, sort_keys=True).encode()).hexdigest()[:8]
+
+    profile["logo_path"] = os.path.join(frappe.get_app_path('gallery_protection'), profile.get("logo") or DEFAULT_LOGO)
+    return profile
+
+
+def get_render_limits():
+    """
+    Memory limits for renders, resolved in the request context and passed
+    to render_watermark alongside the profile
+    """
+    return {
+        "max_pixels": get_max_image_pixels(),
+        "max_edge": int(frappe.conf.get("gallery_render_max_edge") or DEFAULT_RENDER_MAX_EDGE),
+        "pattern_cache_size": max(0, int(frappe.conf.get("gallery_watermark_pattern_cache_size", DEFAULT_CACHED_PATTERNS))),
+    }
+
+
+def get_render_variant(profile, limits=None):
+    variant = f"watermark:{profile['name']}:{profile['version']}:r{RENDERER_VERSION}"
+    if limits:
+        variant += f":{limits['max_edge']}"
+    return variant
+
+
+def _buffer_bytes(image):
+    # Pillow keeps multi-band images at 4 bytes per pixel
+    return image.width * image.height * (1 if image.mode in ("1", "L", "P") else 4)
+
+
+def _cache_get(cache, key, limit, build):
+    with _cache_lock:
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+    value = build()
+    with _cache_lock:
+        cache[key] = value
+        while len(cache) > limit:
+            cache.popitem(last=False)
+    return value
+
+
+def _load_logo(profile, width):
+    """
+    Logo resized to `width` and sharpened, faded to the profile's opacity,
+    and the mask to paste it through: its own alpha before fading, so opacity
+    applies once on top of the logo's original look
+    """
+    def build():
+        resample_filter = getattr(Image, 'Resampling', Image).LANCZOS
+        with Image.open(profile["logo_path"]) as source:
+            logo = source.convert("RGBA")
+        if profile.get("trim"):
+            logo = logo.crop(logo.getchannel("A").getbbox() or (0, 0) + logo.size)
+        height = max(1, int(logo.size[1] * (width / float(logo.size[0]))))
+        logo = logo.resize((width, height), resample_filter)
+        logo = logo.filter(ImageFilter.UnsharpMask(radius=2, percent=120, threshold=3))
+        mask = logo.getchannel("A")
+        opacity = float(profile.get("opacity", 1.0))
+        if opacity < 1.0:
+            logo.putalpha(mask.point(lambda a: int(a * opacity)))
+        return logo, mask
+
+    return _cache_get(_logo_cache, (profile["name"], profile["version"], width), MAX_CACHED_LOGOS, build)
+
+
+def _tile_pattern(profile, width, height, cache_size=DEFAULT_CACHED_PATTERNS):
+    """
+    Full-coverage tiled layer for images up to the size bucket of (width, height).
+    Built once per profile and bucket, then cropped per render; up to
+    `cache_size` patterns are kept.
+    """
+    bucket_width = math.ceil(width / TILE_BUCKET) * TILE_BUCKET
+    bucket_height = math.ceil(height / TILE_BUCKET) * TILE_BUCKET
+
+    def build():
+        logo, mask = _load_logo(profile, max(1, int(bucket_width * float(profile.get("scale", 0.3)))))
+        # Tiles must not overlap, or overlapping edges would blend twice
+        spacing = max(0.0, float(profile.get("spacing", 0.25)))
+        step_x = max(1, int(logo.size[0] * (1 + spacing)))
+        step_y = max(1, int(logo.size[1] * (1 + spacing)))
+
+        pattern = Image.new("RGBA", (bucket_width, bucket_height), (0, 0, 0, 0))
+        for row, y in enumerate(range(0, bucket_height, step_y)):
+            # Offset every other row by half a step for a brick layout
+            start_x = -(step_x // 2) if row % 2 else 0
+            for x in range(start_x, bucket_width, step_x):
+                pattern.paste(logo, (x, y), mask)
+        return pattern
+
+    pattern = _cache_get(_pattern_cache, (profile["name"], profile["version"], bucket_width, bucket_height), cache_size, build)
+    return pattern.crop((0, 0, width, height))
+
+
+def _single_layer(profile, width, height):
+    logo, mask = _load_logo(profile, max(1, int(width * float(profile.get("scale", 1.05)))))
+    logo_width, logo_height = logo.size
+
+    placement = profile.get("placement", "top")
+    if placement == "center":
+        y_pos = (height - logo_height) // 2
+    elif placement == "upper":
+        y_pos = (height - logo_height) // 4
+    else:
+        y_pos = 0
+    offset_x, offset_y = profile.get("offset") or (0, 0)
+
+    layer = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    layer.paste(logo, (int(offset_x), y_pos + int(offset_y)), mask)
+    return layer
+
+
+def render_watermark(image_path: str, profile: dict, limits: dict = None) -> bytes:
+    """
+    Composite the profile's watermark over an image in a single blend and
+    return the encoded result in the image's own format.
+
+    Images over `max_pixels` are refused before decoding; larger ones are
+    decoded at reduced scale where the format allows and shrunk to `max_edge`
+    before compositing. Intermediates are released as soon as they are used.
+    """
+    limits = limits or {"max_pixels": DEFAULT_MAX_IMAGE_PIXELS, "max_edge": DEFAULT_RENDER_MAX_EDGE, "pattern_cache_size": DEFAULT_CACHED_PATTERNS}
+    max_edge = limits["max_edge"]
     resample_filter = getattr(Image, 'Resampling', Image).LANCZOS
+    live = peak = 0
 
-    # draw = ImageDraw.Draw(watermark_layer)
-
-    # Load DejaVu font or fallback
     try:
-        wmark_full_path = os.path.join(
-            frappe.get_app_path('gallery_protection'), wmark_path
-        )
-        watermark = Image.open(wmark_full_path)
-    except IOError:
-        watermark = ""
-        print(f"image not found at {wmark_full_path}")    
-
-    watermark_layer = Image.new("RGBA", image.size, (0, 0, 0, 0))
-
-    # bbox = draw.textbbox((0, 0), text, font=font)
-    # text_width = bbox[2] - bbox[0]
-    # text_height = bbox[3] - bbox[1]
-
-    # draw.text((50, height//2), text, font=font, fill=(50, 50, 50, 50))
-    # draw.text(((width-text_width)-50, height//2), text, font=font, fill=(50, 50, 50, 50))
-
-
-
-    # Resize watermark (optional)
-    scale = 1.05
-    new_width = int(width * scale)
-    w_percent = new_width / float(watermark.size[0])
-    new_height = int((float(watermark.size[1]) * w_percent))
-    watermark = watermark.resize((new_width, new_height), resample_filter)
-    watermark = watermark.filter(ImageFilter.UnsharpMask(radius=2, percent=120, threshold=3))
-
-
-    # Vertical center
-    y_pos = (height - new_height) // 2
-
-
-    # Paste watermark on both left and right 
-    left_pos = (0, 0)
-    # right_pos = (width - new_width - 50, y_pos)
+        with Image.open(image_path) as original_image:
+            original_format = original_image.format
+            width, height = original_image.size
+            if width * height > limits["max_pixels"]:
+                raise ImageTooLarge(f"Image is {width}x{height} pixels, the limit is {limits['max_pixels']} pixels")
+
+            if max(width, height) > max_edge:
+                # JPEG can decode straight to 1/2, 1/4 or 1/8 scale
+                original_image.draft("RGB", (max_edge, max_edge))
+            original_image.load()
+            live = peak = _buffer_bytes(original_image)
+            if max(original_image.size) > max_edge:
+                original_image.thumbnail((max_edge, max_edge), resample_filter, reducing_gap=2.0)
+            image = original_image.convert("RGBA")
+            peak = max(peak, live + _buffer_bytes(image))
+    except Image.DecompressionBombError as e:
+        raise ImageTooLarge(str(e))
+    live = _buffer_bytes(image)
+    width, height = image.size
 
-    watermark_layer.paste(watermark, left_pos, watermark)
-    #watermark_layer.paste(watermark, right_pos, watermark)
+    if profile.get("mode") == "tiled":
+        watermark_layer = _tile_pattern(profile, width, height, limits.get("pattern_cache_size", DEFAULT_CACHED_PATTERNS))
+    else:
+        watermark_layer = _single_layer(profile, width, height)
+    live += _buffer_bytes(watermark_layer)
 
     # Combine and convert to RGB
-    combined = Image.alpha_composite(image, watermark_layer).convert("RGB")
+    combined = Image.alpha_composite(image, watermark_layer)
+    peak = max(peak, live + _buffer_bytes(combined))
+    del image, watermark_layer
+    live = _buffer_bytes(combined)
+    result = combined.convert("RGB")
+    peak = max(peak, live + _buffer_bytes(result))
+    del combined
 
     buffer = io.BytesIO()
-    combined.save(buffer, format=original_format)
+    result.save(buffer, format=original_format)
+    del result
+    record_render_memory(peak)
     return buffer.getvalue()
 
-def add_watermark_half(image_path: str, wmark_path: str = "amanksolutions.png") -> bytes:
-    original_image = Image.open(image_path)
-    original_format = original_image.format
-    image = original_image.convert("RGBA")
-    width, height = image.size
-    resample_filter = getattr(Image, 'Resampling', Image).LANCZOS
-
-    # draw = ImageDraw.Draw(watermark_layer)
-
-    # Load DejaVu font or fallback
-    try:
-        wmark_full_path = os.path.join(
-            frappe.get_app_path('gallery_protection'), wmark_path
-        )
-        watermark = Image.open(wmark_full_path)
-    except IOError:
-        watermark = ""
-        print(f"image not found at {wmark_full_path}")    
-
-    watermark_layer = Image.new("RGBA", image.size, (0, 0, 0, 0))
-    
-    # bbox = draw.textbbox((0, 0), text, font=font)
-    # text_width = bbox[2] - bbox[0]
-    # text_height = bbox[3] - bbox[1]
-
-    # draw.text((50, height//2), text, font=font, fill=(50, 50, 50, 50))
-    # draw.text(((width-text_width)-50, height//2), text, font=font, fill=(50, 50, 50, 50))
-
 
+def _builtin_profile(name, wmark_path):
+    profile = get_watermark_profile(name=name)
+    if wmark_path != DEFAULT_LOGO:
+        profile["logo"] = wmark_path
+        profile["logo_path"] = os.path.join(frappe.get_app_path('gallery_protection'), wmark_path)
+        profile["version"] = f"{profile['version']}-{wmark_path}"
+    return profile
 
-    # Resize watermark (optional)
-    scale = 1.05
-    new_width = int(width * scale)
-    w_percent = new_width / float(watermark.size[0])
-    new_height = int((float(watermark.size[1]) * w_percent))
-    watermark = watermark.resize((new_width, new_height), resample_filter)
-    watermark = watermark.filter(ImageFilter.UnsharpMask(radius=2, percent=120, threshold=3))
 
+def add_watermark(image_path: str, wmark_path: str = DEFAULT_LOGO) -> bytes:
+    return render_watermark(image_path, _builtin_profile("full", wmark_path))
 
-    # Vertical center
-    y_pos = (height - new_height) // 2
 
-
-    # Paste watermark on both left and right 
-    left_pos = (-10, y_pos//2 + 50)
-    # right_pos = (width - new_width - 50, y_pos)
-
-    watermark_layer.paste(watermark, left_pos, watermark)
-    #watermark_layer.paste(watermark, right_pos, watermark)
-
-    # Combine and convert to RGB
-    combined = Image.alpha_composite(image, watermark_layer).convert("RGB")
-
-    buffer = io.BytesIO()
-    combined.save(buffer, format=original_format)
-    return buffer.getvalue()
+def add_watermark_half(image_path: str, wmark_path: str = DEFAULT_LOGO) -> bytes:
+    return render_watermark(image_path, _builtin_profile("half", wmark_path))
@@ -0,0 +1,32 @@
+import click
+import frappe
+from frappe.commands import pass_context, get_site
+
+
+@click.command("migrate-gallery-storage")
+@click.option("--to", "target", type=click.Choice(["local", "s3"]), help="Also copy every image into this storage backend")
+@click.option("--service", "service_id", help="Only copy images of this service")
+@pass_context
+def migrate_gallery_storage(context, target=None, service_id=None):
+	"""
+	Move local gallery images into hash-sharded folders, and optionally copy
+	them into another storage backend. Safe to run again.
+	"""
+	from gallery_protection.api.storage import reshard_local_images, copy_images, get_storage
+
+	site = get_site(context)
+	frappe.init(site=site)
+	frappe.connect()
+	try:
+		moved = reshard_local_images()
+		click.echo(f"Moved {moved} images into sharded folders")
+
+		if target and target != "local":
+			copied, skipped = copy_images(get_storage("local"), get_storage(target), service_id)
+			click.echo(f"Copied {copied} files to {target}, {skipped} already there")
+			click.echo(f"Set gallery_storage_backend to {target} in site config to serve from it")
+	finally:
+		frappe.destroy()
+
+
+commands = [migrate_gallery_storage]
@@ -70,6 +70,8 @@ app_license = "MIT"
 # before_install = "gallery_protection.install.before_install"
 # after_install = "gallery_protection.install.after_install"
 
+after_migrate = ["gallery_protection.api.popularity.enqueue_warm_popular_renders"]
+
 # Uninstallation
 # ------------
 
@@ -133,6 +135,24 @@ app_license = "MIT"
 # Scheduled Tasks
 # ---------------
 
+scheduler_events = {
+	"cron": {
+		"* * * * *": [
+			"gallery_protection.api.form_handler.flush_form_queue"
+		],
+		"*/10 * * * *": [
+			"gallery_protection.api.popularity.flush_popularity"
+		]
+	},
+	"hourly": [
+		"gallery_protection.api.popularity.warm_popular_renders",
+		"gallery_protection.api.session_manager.prune_session_indexes"
+	],
+	"daily": [
+		"gallery_protection.api.image_store.prune_store"
+	],
+}
+
 # scheduler_events = {
 # 	"all": [
 # 		"gallery_protection.tasks.all"